@@ -0,0 +1,290 @@
+"""
+Consistency checks and timings for the alternative implementations.
+
+Not needed for production. Run as a script (synthetic inputs only, no datacube required):
+
+>>> python benchmark.py
+
+Each check asserts agreement with the reference implementation before reporting timings.
+"""
+
+import time
+import math
+import collections
+import multiprocessing
+import numpy
+import xarray
+import scipy.ndimage
+import classifier_josh as classifier
+import filters
+import blockwise
+import dilation
+import terrain_greg as terrain
+import pipeline
+
+
+tile_shape = (4000, 4000) # 100km at 25m
+
+def timed(func, *args, **kwargs):
+    """Return result and walltime (seconds) of a function call"""
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+def synthetic_nbar(shape=tile_shape, seed=0):
+    """Random int16 surface reflectance stack (bands 1-5, 7)"""
+    rng = numpy.random.RandomState(seed)
+    return rng.randint(-100, 5000, size=(6,) + shape).astype(numpy.int16)
+
+def edge_case_nbar(shape=(500, 500), seed=1):
+    """NBAR drawn from values near thresholds, zero and opposite-sign pairs, and int16 extremes"""
+    rng = numpy.random.RandomState(seed)
+    pool = numpy.array([-32768, -999, -130, -1, 0, 1, 129, 130, 300, 301, 323, 324, 334, 335,
+                        364, 365, 379, 380, 473, 474, 1400, 1401, 2083, 2084, 32767], dtype=numpy.int16)
+    images = pool[rng.randint(0, len(pool), size=(6,) + shape)]
+    images[1, ::7] = -images[4, ::7] # zero denominators for NDI 52
+    images[2, ::5] = -images[3, ::5] # and for NDI 43
+    return images
+
+def synthetic_dsm(shape=tile_shape, seed=5):
+    """Rough synthetic terrain (metres): smooth relief at several scales plus pixel noise"""
+    rng = numpy.random.RandomState(seed)
+    elevation = numpy.zeros(shape)
+    for scale in [512, 128, 32, 8, 2]:
+        coarse = rng.randn(shape[0]//scale + 2, shape[1]//scale + 2)
+        elevation += scipy.ndimage.zoom(coarse, scale, order=1)[:shape[0], :shape[1]] * scale * 6
+    elevation += rng.randn(*shape) * 3
+    return elevation.astype(numpy.float32)
+
+def synthetic_pq(shape=tile_shape, seed=2):
+    """Random 16-bit pixel quality, mostly clear with scattered cloud, shadow, sea and saturation"""
+    rng = numpy.random.RandomState(seed)
+    pq = numpy.full(shape, 0x3FFF, dtype=numpy.uint16)
+    for bits, fraction in [(0x0400, 0.001), (0x1000, 0.001), (0x0200, 0.01), (0x009F, 0.01)]:
+        pq[rng.random_sample(shape) < fraction] &= ~numpy.uint16(bits)
+    return pq
+
+def as_dataset(images, nodata):
+    """Wrap band stack as an xarray Dataset with per-band nodata attributes"""
+    names = ['blue', 'green', 'red', 'nir', 'swir1', 'swir2']
+    return xarray.Dataset(collections.OrderedDict(
+        (name, xarray.DataArray(band, dims=('y', 'x'), attrs={'nodata': value}))
+        for name, band, value in zip(names, images, nodata)))
+
+def check_ratio_bounds(span=400):
+    """Exhaustively compare integer and float32 ratio tests over small band values"""
+    a, b = numpy.meshgrid(numpy.arange(-span, span+1), numpy.arange(-span, span+1))
+    images = numpy.zeros((6,) + a.shape, dtype=numpy.int16)
+    images[4], images[1] = a, b
+    images[3], images[2] = a, b
+    images[5] = a
+    exact = classifier._integer_features(images)
+    approx = classifier._float_features(images, numpy.float32)
+    for name, threshold in [('ndi_52', -0.01), ('ndi_52', 0.12), ('ndi_52', 0.23), ('ndi_52', 0.34),
+                            ('ndi_43', -0.01), ('ndi_43', 0.22), ('ndi_43', 0.45),
+                            ('ndi_43', 0.54), ('ndi_43', 0.61), ('ndi_72', -0.23)]:
+        assert (exact(name, threshold) == approx(name, threshold)).all(), (name, threshold)
+
+def benchmark_classifier():
+    check_ratio_bounds()
+
+    images = edge_case_nbar()
+    reference = classifier.classify(images)
+    assert (classifier.classify_blockwise(images) == reference).all()
+    assert (classifier.classify_blockwise(images, integer=True) == reference).all()
+
+    images = synthetic_nbar()
+    reference, t = timed(classifier.classify, images)
+    print "classify (reference)          %.2fs" % t
+    result, t = timed(classifier.classify_blockwise, images)
+    assert (result == reference).all()
+    print "classify_blockwise            %.2fs" % t
+    result, t = timed(classifier.classify_blockwise, images, integer=True)
+    assert (result == reference).all()
+    print "classify_blockwise (integer)  %.2fs" % t
+    try:
+        result, t = timed(classifier.classify_numexpr, images)
+    except ImportError:
+        print "classify_numexpr              (numexpr unavailable)"
+    else:
+        assert (result == reference).all()
+        print "classify_numexpr              %.2fs" % t
+
+def benchmark_woffles():
+    images = synthetic_nbar()
+    nodata = [-999] * 5 + [-1]
+    images[:, :100, :100] = -999
+    images[5, :100, :100] = -1
+    source = as_dataset(images, nodata)
+    pq = synthetic_pq()
+
+    def separately():
+        return classifier.classify(source.to_array(dim='band').data) \
+               | filters.eo_filter(source) \
+               | filters.pq_filter(pq)
+    reference, t = timed(separately)
+    print "classify | eo_filter | pq_filter  %.2fs" % t
+    result, t = timed(blockwise.woffles_blockwise, list(images), nodata, pq)
+    assert (result == reference).all()
+    print "woffles_blockwise               %.2fs" % t
+
+def benchmark_pq():
+    pq = synthetic_pq()
+    words = numpy.arange(2**16, dtype=numpy.uint16).reshape(256, 256)
+    assert (filters.pq_filter(words) == filters.pq_filter_bitwise(words)).all()
+    assert (filters.pq_filter(words.view(numpy.int16)) == filters.pq_filter_bitwise(words.view(numpy.int16))).all()
+
+    reference, t = timed(filters.pq_filter_bitwise, pq)
+    print "pq_filter_bitwise               %.2fs" % t
+    result, t = timed(filters.pq_filter, pq)
+    assert (result == reference).all()
+    print "pq_filter (lookup table)        %.2fs" % t
+    _, t = timed(filters.pq_filter_bitwise, pq, dilation=0)
+    print "  decoding only, bitwise        %.2fs" % t
+    _, t = timed(filters.pq_filter, pq, dilation=0)
+    print "  decoding only, lookup table   %.2fs" % t
+
+def benchmark_dilation():
+    rng = numpy.random.RandomState(3)
+    for shape in [(1, 1), (1, 9), (9, 1), (5, 6), (40, 33)]:
+        for iterations in [1, 2, 3, 5]:
+            mask = rng.random_sample(shape) < 0.1
+            assert (dilation.dilate(mask, iterations) == filters.dilate_scipy(mask, iterations)).all()
+
+    mask = rng.random_sample(tile_shape) < 0.001
+    reference, t = timed(filters.dilate_scipy, mask)
+    print "dilate_scipy                    %.2fs" % t
+    result, t = timed(dilation.dilate, mask)
+    assert (result == reference).all()
+    print "dilate (running OR)             %.2fs" % t
+
+def benchmark_eo():
+    images = synthetic_nbar()
+    nodata = [-999, -999, -999, -999, -1, 0]
+    rng = numpy.random.RandomState(4)
+    for band, value in zip(images, nodata):
+        band[rng.random_sample(band.shape) < 0.01] = value
+    images[:, :100, :100] = numpy.array(nodata, dtype=numpy.int16)[:, None, None]
+    source = as_dataset(images, nodata)
+
+    def stacked():
+        nodata_bools = source.apply(lambda array: array == array.nodata).to_array(dim='band')
+        return numpy.uint8(1) * nodata_bools.all(dim='band').data | \
+               numpy.uint8(2) * nodata_bools.any(dim='band').data
+    reference, t = timed(stacked)
+    print "eo_filter (stacked DataArrays)  %.2fs" % t
+    result, t = timed(filters.eo_filter, source)
+    assert (result == reference).all()
+    print "eo_filter (streaming)           %.2fs" % t
+
+def benchmark_shading(sun_altitudes=(10, 30, 50)):
+    no_data = -1000
+    rotated = scipy.ndimage.interpolation.rotate(synthetic_dsm(), 30, reshape=True, output=numpy.float32,
+                                                 cval=no_data, prefilter=False)
+    for altitude in sun_altitudes:
+        altitude = math.radians(altitude)
+        def row_by_row():
+            shadows = numpy.zeros_like(rotated)
+            for row in range(rotated.shape[0]):
+                terrain._shadeRow(shadows[row], rotated[row], altitude, 25.0, no_data, fuzz=10.0)
+            return shadows
+        def banded():
+            shadows = numpy.zeros_like(rotated)
+            for start in range(0, rotated.shape[0], terrain.SHADE_BAND_ROWS):
+                band = slice(start, start + terrain.SHADE_BAND_ROWS)
+                terrain._shadeRows(shadows[band], rotated[band], altitude, 25.0, no_data, fuzz=10.0)
+            return shadows
+        reference, t = timed(row_by_row)
+        print "_shadeRow loop (sun alt %2.0f)    %.2fs" % (math.degrees(altitude), t)
+        result, t = timed(banded)
+        assert (result == reference).all()
+        print "_shadeRows     (sun alt %2.0f)    %.2fs" % (math.degrees(altitude), t)
+
+def benchmark_shadow_methods(sun_azimuths=(30, 135, 250), sun_altitude=25):
+    elevation = synthetic_dsm()
+    altitude = math.radians(sun_altitude)
+    for azimuth in sun_azimuths:
+        azimuth = math.radians(azimuth)
+        rotated, t = timed(terrain._rotated_shadows, elevation, azimuth, altitude, 25.0, -1000)
+        print "rotate shadows  (sun az %3.0f)   %.2fs" % (math.degrees(azimuth), t)
+        swept, t = timed(terrain._swept_shadows, elevation, azimuth, altitude, 25.0, -1000)
+        agreement = terrain.shadow_agreement(rotated, swept)
+        print "sweep shadows   (sun az %3.0f)   %.2fs, agreement %.3f" % (math.degrees(azimuth), t, agreement)
+
+def benchmark_threads(thread_counts=None, sun_azimuth=30, sun_altitude=25):
+    """
+    Scaling of the terrain stage (Sobel/slope, masks, and both shadow methods) on a full tile
+    with terrain.THREADS, as speedup over one thread. By default, doubles the threads up to the
+    available cores (beyond which any speedup only reflects I/O or GIL release, not more CPU).
+    """
+    cores = multiprocessing.cpu_count()
+    if thread_counts is None:
+        thread_counts = [2**k for k in range(int(math.log(cores, 2)) + 1)]
+        thread_counts += [] if cores in thread_counts else [cores]
+    elevation = synthetic_dsm()
+    class tile: # stands in for the DSM Dataset
+        class affine:
+            a, e = 25.0, -25.0
+    tile.elevation = xarray.DataArray(elevation, dims=('y', 'x'))
+    azimuth, altitude = math.radians(sun_azimuth), math.radians(sun_altitude)
+    vector = (math.sin(azimuth) * math.cos(altitude), -math.cos(azimuth) * math.cos(altitude),
+              math.sin(altitude), azimuth, altitude)
+    stages = [('derivatives', lambda: terrain.terrain_derivatives(tile)),
+              ('masks', lambda: terrain.terrain_masks(tile, vector, 12.0, 30.0)),
+              ('rotate', lambda: terrain._rotated_shadows(elevation, azimuth, altitude, 25.0, -1000)),
+              ('sweep', lambda: terrain._swept_shadows(elevation, azimuth, altitude, 25.0, -1000))]
+    print "terrain threads (%d cores available)" % cores
+    default = terrain.THREADS
+    single = {}
+    for threads in thread_counts:
+        terrain.THREADS = threads
+        report = []
+        for name, stage in stages:
+            _, t = timed(stage)
+            single.setdefault(name, t)
+            report.append("%s %.2fs (x%.1f)" % (name, t, single[name] / t))
+        print "  %2d threads   %s" % (threads, ", ".join(report))
+    terrain.THREADS = default
+
+def benchmark_pipeline(tasks=20, seconds=0.05):
+    """Pipelined versus sequential stages (simulated by sleeps), and prompt failure mid-pipeline"""
+    def load(task):
+        time.sleep(seconds)
+        return [task] * 100
+    def compute(inputs):
+        time.sleep(seconds)
+        return sum(inputs)
+    def write(task, inputs, output):
+        time.sleep(seconds)
+        return task, output
+    expected = [(task, 100 * task) for task in range(tasks)]
+    result, t = timed(lambda: [write(task, None, compute(load(task))) for task in range(tasks)])
+    print "sequential stages               %.2fs" % t
+    for budget in [10**6, 250, 1]:
+        result, t = timed(pipeline.pipelined, range(tasks), load, compute, write, budget=budget, size=len)
+        assert result == expected
+        print "pipelined (budget %7d)       %.2fs" % (budget, t)
+
+    def failing(inputs): # while the next prefetch waits on the budget
+        if inputs[0] == 2:
+            raise ValueError(inputs[0])
+        return compute(inputs)
+    try:
+        timed(pipeline.pipelined, range(tasks), load, failing, write, budget=150, size=len)
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+if __name__ == '__main__':
+    numpy.seterr(divide='ignore', invalid='ignore')
+    benchmark_classifier()
+    benchmark_woffles()
+    benchmark_pq()
+    benchmark_dilation()
+    benchmark_eo()
+    benchmark_shading()
+    benchmark_shadow_methods()
+    benchmark_threads()
+    benchmark_pipeline()
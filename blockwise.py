@@ -0,0 +1,66 @@
+"""
+Fused production path for the per-pixel parts of the WOFL algorithm.
+
+The decision tree, EO nodata filter and PQ filter are evaluated together in one sweep over
+blocks of rows, so that the full-tile float copy and boolean temporaries are never allocated.
+Dilated PQ flags (cloud and cloud shadow) are computed over each block extended by a halo
+of rows, then cropped, which reproduces whole-tile dilation exactly (including at block seams).
+
+The terrain filter is not fused, as it requires whole-tile context (rotation and shadow casting).
+"""
+
+import numpy as np
+import classifier_josh as classifier
+import filters
+
+BLOCK_PIXELS = 2**18 # larger than the classifier blocks, to amortise the dilation halo
+
+def row_blocks(rows, cols, block_rows=None, halo=0):
+    """
+    Yield (extended, crop) slice pairs covering the rows.
+
+    The extended slice includes up to halo rows either side of the block (clipped to the array),
+    and the crop slice selects the block itself from within the extended rows.
+    """
+    if block_rows is None:
+        block_rows = max(1, BLOCK_PIXELS // max(cols, 1))
+    for start in range(0, rows, block_rows):
+        stop = min(start + block_rows, rows)
+        lo = max(start - halo, 0)
+        hi = min(stop + halo, rows)
+        yield slice(lo, hi), slice(start - lo, stop - lo)
+
+def woffles_blockwise(bands, nodata, pq, block_rows=None, dilation=3):
+    """
+    Water classification combined with EO and PQ filter flags, equivalent to
+
+        classify(bands) | eo_filter(source) | pq_filter(pq)
+
+    :param bands:
+        Sequence of six 2D arrays (Landsat bands 1-5, 7), e.g. the variables of the NBAR Dataset
+        (avoiding the stacked copy made by to_array) or a 3D array ordered (band, y, x).
+
+    :param nodata:
+        Sequence of nodata values, one per band.
+
+    :param pq:
+        2D numpy array of the 16-bit pixel quality product.
+
+    :return:
+        A 2D numpy array of type UInt8, the WOFL bitfield less the terrain flags.
+    """
+    assert len(bands) == len(nodata) == 6
+    rows, cols = pq.shape
+    water = np.empty((rows, cols), dtype=np.uint8)
+
+    for extended, crop in row_blocks(rows, cols, block_rows, halo=dilation):
+        block = slice(extended.start + crop.start, extended.start + crop.stop)
+        out = water[block]
+
+        stack = np.stack([band[block] for band in bands])
+        out[:] = classifier.classify_blockwise(stack, block_rows=out.shape[0])
+
+        out |= filters.nodata_filter(stack, nodata)
+        out |= filters.pq_filter(pq[extended], dilation=dilation)[crop]
+
+    return water
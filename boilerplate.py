@@ -8,12 +8,27 @@ import datacube
 import pathlib
 import errno 
 import xarray
+import numpy
 import pandas
 import datacube.model.utils
 import yaml
 import click
 import pickle
 import itertools
+import multiprocessing
+import solar
+import halo
+import dsm_store
+import executors
+import index_writer
+import task_store
+import catalogue as catalogue_snapshot
+import pipeline
+import zarr_output
+import chunked
+import time
+import terrain_greg as terrain
+import terrain_cache
 
 info = {'lineage': { 'algorithm': { 'name': "WOFS decision-tree water extents",
                                     'version': 'unknown',
@@ -37,25 +52,46 @@ def unpickle_stream(pickle_file):
         except EOFError:
             raise StopIteration
             
-def map_orderless(core,tasks,queue=50):
-    """Utility to stream tasks through compute resources"""
-    import distributed # slow import
-    ex = distributed.Client() # executor  
-    
-    tasks = (i for i in tasks) # ensure input is a generator
-      
-    # pre-fill queue
-    results = [ex.submit(core,*t) for t in itertools.islice(tasks, queue)]
-           
-    while results:
-        result = next(distributed.as_completed(results)) # block
-        results.remove(result)                  # pop completed
+def dsm_identity(task):
+    """Utility to identify the DSM tile of a task (by its source datasets)"""
+    loadables = task[0]
+    return tuple(sorted(str(ds.id) for ds in loadables[2].sources.values[0]))
 
-        task = next(tasks, None)
-        if task is not None:
-            results.append(ex.submit(core,*task)) # queue another
-        
-        yield result.result() # unwrap future
+def is_task_store(path):
+    """Utility to distinguish a task store (see task_store) from a pickled task stream"""
+    return path.endswith('.db') or path.endswith('.sqlite')
+
+def group_tasks(tasks, size=0):
+    """Utility to batch consecutive tasks that share a DSM tile (into batches of limited size, if nonzero)"""
+    for _, group in itertools.groupby(tasks, key=dsm_identity):
+        group = list(group)
+        limit = size or len(group)
+        for start in range(0, len(group), limit):
+            yield group[start:start + limit]
+
+def size_caches(tasks):
+    """Utility to keep a DSM tile cached for each of the concurrent tasks of a process"""
+    terrain_cache.shared.maxsize = max(terrain_cache.shared.maxsize, tasks)
+    halo.shared.maxsize = max(halo.shared.maxsize, 8 * tasks) # (up to 8 neighbours per tile)
+
+def map_orderless(core,tasks,queue=50,backend='distributed',workers=None):
+    """Utility to stream tasks through compute resources (see executors)"""
+    if backend == 'thread': # tasks share this process (and its caches)
+        size_caches(workers or multiprocessing.cpu_count())
+    executor = executors.BACKENDS[backend](workers)
+    # start about one task per worker, and grow as completions show capacity (see executors.Backlog),
+    # so that tasks (e.g. batches claimed from a task store) are not taken far ahead of their submission
+    backlog = executors.Backlog(maximum=queue, initial=workers or multiprocessing.cpu_count())
+    try:
+        for result in executors.map_orderless(core, tasks, executor, backlog):
+            yield result
+    finally:
+        executor.shutdown()
+
+class TaskFailure(object):
+    """Result of a task that raised (see perform_group)"""
+    def __init__(self, error):
+        self.error = repr(error)
 
 def get_product(index, definition):
     """Utility to get database-record corresponding to product-definition"""
@@ -84,6 +120,15 @@ def box_and_envelope(loadables):
         return datacube.model.GeoPolygon(overlap, crs)    
     return bounding_box, valid_data_envelope()
 
+def load_strip(tile, rows, cols, store=None):
+    """Utility to load a (rows, cols) portion of a DSM tile, as a 2D elevation array"""
+    if store:
+        stored = dsm_store.load(store, tile.geobox)
+        if stored is not None:
+            return numpy.array(stored.elevation.values[rows, cols]) # copy from the memory-map
+    strip = datacube.api.GridWorkflow.load(tile[:, rows, cols], resampling='cubic')
+    return strip.elevation.values[0]
+
 def docvariable(agdc_dataset, time):
     """Utility to convert datacube dataset to xarray/NetCDF variable"""
     array = xarray.DataArray([agdc_dataset], coords=[time])
@@ -97,6 +142,12 @@ def docvariable(agdc_dataset, time):
 class datacube_application:
     """Nonspecific application workflow."""
     info = NotImplemented
+    threads = 1 # per task (see terrain_greg.THREADS)
+    dsm_store = None # directory of pre-reprojected DSM tiles (see dsm_store)
+    pipeline_budget = 0 # MB of prefetched inputs per worker, if pipelining tasks (see pipeline)
+    shadow_tolerance = 0 # degrees of sun position, if memoising terrain shadows (see terrain_cache.ShadowCache)
+    dask_chunks = 0 # pixels (square), if processing lazily in chunks (see chunked)
+    output_format = 'netcdf' # or 'zarr', or 'zarr-stack' (a store per tile and year, see zarr_output.TimeStack)
     def generate_tasks(self, index, time_range):
         """Prepare stream of tasks (i.e. of argument tuples)."""
         raise NotImplemented
@@ -131,46 +182,117 @@ class datacube_application:
         
         @cli.command(help="Pre-query tiles for one calendar year.")
         @click.argument('year', type=click.INT)
-        @click.argument('taskfile', type=click.File('w'))
+        @click.argument('taskfile', type=click.Path())
         @click.option('--max', default=0, help="Limit number of tasks")
-        def prepare(year, taskfile, max):
+        @click.option('--halo', is_flag=True, help="Include neighbouring DSM tiles (see halo module)")
+        @click.option('--catalogue', default=None, help="Snapshot file, for incremental discovery")
+        def prepare(year, taskfile, max, halo, catalogue):
             t = str(year)+'-01-01', str(year+1)+'-01-01'
             print "Querying", t[0], "to", t[1]
-            stream = pickle.Pickler(taskfile)
-            i = 0
-            for task in self.generate_tasks(index, time=t):
-                stream.dump(task)
-                i += 1
-                if i==max:
-                    break
-            print i, "tasks prepared"         
+            snapshot = catalogue and catalogue_snapshot.Catalogue(catalogue)
+            tasks = itertools.islice(self.generate_tasks(index, time=t, halo=halo, catalogue=snapshot), max or None)
+            tasks = solar.attach_solar_vectors(tasks) # batch precompute sun positions
+            if is_task_store(taskfile): # seekable and shardable
+                task_store.TaskStore(taskfile).add(tasks, group=dsm_identity)
+            else:
+                with open(taskfile, 'w') as f:
+                    stream = pickle.Pickler(f)
+                    for task in tasks:
+                        stream.dump(task)
+            if snapshot:
+                snapshot.save() # after the tasks are safely stored
+            print len(tasks), "tasks prepared"         
            
         @cli.command(help="Read pre-queried tiles and distribute computation.")
         @click.option('--backlog', default=50, help="Maximum queue length")
-        @click.argument('taskfile', type=click.File('r'))
-        def orchestrate(backlog, taskfile):
-            tasks = unpickle_stream(taskfile)
-            done_tasks = map_orderless(self.perform_task, tasks, queue=backlog)
-            for i,ds in enumerate(done_tasks):
-                print i
-                index.datasets.add(ds, skip_sources=True) # index completed work
+        @click.option('--threads', default=1, help="Worker threads per task")
+        @click.option('--group', default=32, help="Maximum tasks per DSM tile batch")
+        @click.option('--dsm-store', default=None, help="Directory of pre-reprojected DSM tiles")
+        @click.option('--executor', default='distributed', type=click.Choice(sorted(executors.BACKENDS)),
+                      help="Compute backend")
+        @click.option('--workers', default=0, help="Worker count (default: all cores)")
+        @click.option('--index-batch', default=20, help="Datasets indexed per transaction")
+        @click.option('--shard', default=None, help="Only process shard i/N of a task store")
+        @click.option('--resume', is_flag=True, help="Retry failed or stale tasks of a task store")
+        @click.option('--stale', default=24.0, help="Hours after which unfinished claimed tasks are stale")
+        @click.option('--pipeline-budget', default=0, help="MB per worker for prefetching inputs (0 disables)")
+        @click.option('--shadow-tolerance', default=0.0, help="Degrees of sun position to memoise shadows within (0 disables)")
+        @click.option('--dask-chunks', default=0, help="Process lazily in chunks of this many pixels square (0 disables)")
+        @click.option('--output-format', default='netcdf', type=click.Choice(['netcdf', 'zarr', 'zarr-stack']))
+        @click.argument('taskfile', type=click.Path(exists=True))
+        def orchestrate(backlog, threads, group, dsm_store, executor, workers, index_batch,
+                        shard, resume, stale, pipeline_budget, shadow_tolerance, dask_chunks, output_format, taskfile):
+            self.threads = threads
+            self.shadow_tolerance = shadow_tolerance
+            self.dask_chunks = dask_chunks
+            self.dsm_store = dsm_store
+            self.pipeline_budget = pipeline_budget
+            self.output_format = output_format
+            if is_task_store(taskfile):
+                store = task_store.TaskStore(taskfile)
+                if resume:
+                    print store.resume(stale=stale*3600), "tasks to retry"
+                batches = store.batches(size=group, shard=shard and task_store.parse_shard(shard))
+                done_batches = map_orderless(self.perform_stored, batches, queue=backlog,
+                                             backend=executor, workers=workers or None)
+                def done_tasks():
+                    for ids, results, duration in done_batches:
+                        done = [i for i, result in zip(ids, results) if not isinstance(result, TaskFailure)]
+                        store.finish(done, duration)
+                        for i, result in zip(ids, results):
+                            if isinstance(result, TaskFailure):
+                                store.finish([i], duration, result.error)
+                                print "Failed", i, result.error
+                            else:
+                                yield result
+                done_tasks = done_tasks()
+            else:
+                tasks = unpickle_stream(open(taskfile, 'r'))
+                batches = ((batch,) for batch in group_tasks(tasks, size=group)) # argument tuples
+                done_tasks = itertools.chain.from_iterable(map_orderless(self.perform_group, batches, queue=backlog,
+                                                                         backend=executor, workers=workers or None))
+            with index_writer.IndexWriter(index, batch=index_batch) as writer:
+                for i,ds in enumerate(done_tasks):
+                    print i
+                    writer.add(ds) # index completed work (in background)
             print "Done"
         
         @cli.command(help="Query and execute in single thread")
         @click.argument('year', type=click.INT)
         @click.option('--max', default=0, help="Limit number of tasks")
-        def debug(year, max):
+        @click.option('--threads', default=1, help="Worker threads per task")
+        @click.option('--dsm-store', default=None, help="Directory of pre-reprojected DSM tiles")
+        @click.option('--index-batch', default=20, help="Datasets indexed per transaction")
+        @click.option('--pipeline-budget', default=0, help="MB for prefetching inputs (0 disables)")
+        @click.option('--shadow-tolerance', default=0.0, help="Degrees of sun position to memoise shadows within (0 disables)")
+        @click.option('--dask-chunks', default=0, help="Process lazily in chunks of this many pixels square (0 disables)")
+        @click.option('--output-format', default='netcdf', type=click.Choice(['netcdf', 'zarr', 'zarr-stack']))
+        def debug(year, max, threads, dsm_store, index_batch, pipeline_budget, shadow_tolerance, dask_chunks,
+                  output_format):
+            self.threads = threads
+            self.shadow_tolerance = shadow_tolerance
+            self.dask_chunks = dask_chunks
+            self.dsm_store = dsm_store
+            self.pipeline_budget = pipeline_budget
+            self.output_format = output_format
             t = str(year)+'-01-01', str(year+1)+'-01-01'
             print "Querying", t[0], "to", t[1]
+            tasks = itertools.islice(self.generate_tasks(index, time=t), max or None)
             i = 0
-            for task in self.generate_tasks(index, time=t):
-                i += 1
-                print i
-                ds = self.perform_task(*task)
-                index.datasets.add(ds, skip_sources=True) # index completed work
-                if i==max:
-                    break
+            with index_writer.IndexWriter(index, batch=index_batch) as writer:
+                for batch in group_tasks(tasks):
+                    for ds in self.perform_group(batch):
+                        i += 1
+                        print i
+                        writer.add(ds) # index completed work (in background)
             print "Done" 
+
+        @cli.command(help="Store the DSM reprojected onto the product grid (one-off).")
+        @click.argument('directory')
+        def store_dsm(directory):
+            for i, tile_index in dsm_store.build(index, directory, product=self.product.name):
+                print i, tile_index
+            print "Done"
                
         cli()
 
@@ -180,57 +302,204 @@ class datacube_application:
 class wofloven(datacube_application):
     """Specialisations for Water Observation product"""
     info = info
-    def generate_tasks(self, index, time, extent={}):
+    def generate_tasks(self, index, time, extent={}, halo=False, catalogue=None):
         """ Yield loadables (nbar,ps,dsm) and targets, for dispatch to workers.
 
         This function is the equivalent of an SQL join query,
         and is required as a workaround for datacube API abstraction layering.        
+
+        Optionally (halo), also yields the neighbouring DSM tiles, to avoid terrain edge artefacts.
+        Optionally (catalogue), discovers only tasks that are new since the last snapshot.
         """
         gw = datacube.api.GridWorkflow(index, product=self.product.name) # GridSpec from product definition
 
-        wofls_loadables = gw.list_tiles(product=self.product.name, time=time, **extent)
+        def list_dsm_tiles():
+            dsm_loadables = gw.list_tiles(product='dsm1sv10', **extent)
+            assert len(set(t for (x,y,t) in dsm_loadables)) == 1 # assume mosaic won't require extra fusing
+            return {(x,y):val for (x,y,t),val in dsm_loadables.items()} # make mosaic atemporal
 
-        for platform in sensor.keys():
-            source_loadables = gw.list_tiles(product=platform+'_nbar_albers', time=time, **extent)
-            pq_loadables = gw.list_tiles(product=platform+'_pq_albers', time=time, **extent)
-            dsm_loadables = gw.list_tiles(product='dsm1sv10', **extent)                
+        if catalogue is None:
+            dsm_loadables = list_dsm_tiles()
+        else:
+            catalogue.reset(extent)
+            dsm_loadables = catalogue.dsm_tiles(list_dsm_tiles)
 
-            assert len(set(t for (x,y,t) in dsm_loadables)) == 1 # assume mosaic won't require extra fusing
-            dsm_loadables = {(x,y):val for (x,y,t),val in dsm_loadables.items()} # make mosaic atemporal
+        windows = {platform: time if catalogue is None else catalogue.window(platform, time)
+                   for platform in sensor.keys()}
+        earliest = min(pandas.to_datetime(start) for start, end in windows.values()).isoformat()
+        wofls_loadables = gw.list_tiles(product=self.product.name, time=(earliest, time[1]), **extent)
+
+        eo_loadables = {}
+        for platform in sensor.keys():
+            source_loadables = gw.list_tiles(product=platform+'_nbar_albers', time=windows[platform], **extent)
+            pq_loadables = gw.list_tiles(product=platform+'_pq_albers', time=windows[platform], **extent)
 
             # only valid where EO, PQ and DSM are *all* available (and WOFL isn't yet)
             keys = set(source_loadables) & set(pq_loadables) .difference(set(wofls_loadables))
-            # should sort spatially, consider repartitioning workload to minimise DSM reads.
             for x,y,t in keys:
                 if (x,y) in dsm_loadables: # filter complete
-                    fn = filename_template.format(sensor=sensor[platform],
-                                                  tile_index=(x,y),
-                                                  time=pandas.to_datetime(t).strftime('%Y%m%d%H%M%S%f'))
-                    s,p,d = map(gw.update_tile_lineage, # fully flesh-out the metadata
-                                [ source_loadables[(x,y,t)], pq_loadables[(x,y,t)], dsm_loadables[(x,y)] ])
-                    yield ((s,p,d), pathlib.Path(destination,fn))
-
-    def perform_task(self, loadables, file_path):
+                    if catalogue is None or catalogue.is_new((x,y,t,platform)):
+                        eo_loadables[(x,y,t,platform)] = source_loadables[(x,y,t)], pq_loadables[(x,y,t)]
+
+        dsm_lineage = {} # (x,y) -> DSM tile, fleshed out once however many tasks (or neighbours) use it
+        def dsm_tile(xy):
+            if xy not in dsm_lineage:
+                dsm_lineage[xy] = gw.update_tile_lineage(dsm_loadables[xy])
+            return dsm_lineage[xy]
+
+        # sort spatially, so that tasks sharing a DSM tile are consecutive (see group_tasks)
+        for x,y,t,platform in sorted(eo_loadables):
+            fn = filename_template.format(sensor=sensor[platform],
+                                          tile_index=(x,y),
+                                          time=pandas.to_datetime(t).strftime('%Y%m%d%H%M%S%f'))
+            s,p = map(gw.update_tile_lineage, eo_loadables[(x,y,t,platform)]) # fully flesh-out the metadata
+            d = dsm_tile((x,y))
+            if catalogue is not None:
+                catalogue.record((x,y,t,platform))
+            if not halo:
+                yield ((s,p,d), pathlib.Path(destination,fn))
+                continue
+            neighbours = {(dx,dy): ((x+dx,y+dy), dsm_tile((x+dx,y+dy)))
+                          for dx in (-1,0,1) for dy in (-1,0,1)
+                          if (dx or dy) and (x+dx,y+dy) in dsm_loadables}
+            yield ((s,p,d), pathlib.Path(destination,fn), neighbours)
+
+        if catalogue is not None:
+            catalogue.complete(time)
+
+    def perform_group(self, tasks, guard=False):
+        """ Perform a batch of tasks that share a DSM tile (see group_tasks),
+        loading and reprojecting the DSM only once.
+
+        Optionally (guard), a failing task does not abandon the rest of the batch,
+        but its result is a TaskFailure instead.
+        
+        Output:
+            - list of indexable objects
+        """
+        def attempt(function, *args, **kwargs):
+            for arg in args:
+                if isinstance(arg, TaskFailure): # i.e. an earlier stage failed
+                    return arg
+            if not guard:
+                return function(*args, **kwargs)
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                return TaskFailure(e)
+
+        dsm = attempt(self.load_dsm, tasks[0][0][2])
+        if isinstance(dsm, TaskFailure):
+            return [dsm] * len(tasks)
+        if not self.pipeline_budget:
+            return [attempt(self.perform_task, *task, dsm=dsm) for task in tasks]
+
+        # overlap loading and writing with computation (see pipeline)
+        def load(task):
+            return attempt(self.load_task, *task, dsm=dsm)
+        def compute(inputs):
+            return attempt(lambda inputs: self.evaluate(*inputs), inputs)
+        def write(task, inputs, result):
+            loadables, file_path = task[:2]
+            return attempt(lambda inputs, result: self.write_task(loadables, file_path, inputs[0], result),
+                           inputs, result)
+        def size(inputs):
+            if isinstance(inputs, TaskFailure):
+                return 0
+            source, pq, extended = inputs
+            return source.nbytes + pq.nbytes + (extended.nbytes if extended is not dsm else 0)
+        return pipeline.pipelined(tasks, load, compute, write, budget=self.pipeline_budget * 2**20, size=size)
+
+    def perform_stored(self, ids, tasks):
+        """ Perform a batch claimed from a task store (see task_store), without raising.
+
+        Output:
+            - ids, list of indexable objects (or TaskFailure) per task, and duration (seconds)
+        """
+        start = time.time()
+        results = self.perform_group(tasks, guard=True)
+        return ids, results, time.time() - start
+
+    def load_dsm(self, protodsm):
+        """DSM tile (2D), from the pre-reprojected store if configured and available (see dsm_store)"""
+        if self.dsm_store:
+            dsm = dsm_store.load(self.dsm_store, protodsm.geobox)
+            if dsm is not None:
+                return dsm
+        return datacube.api.GridWorkflow.load(protodsm, resampling='cubic').isel(time=0)
+
+    def perform_task(self, loadables, file_path, solar_vector=None, dsm_neighbours=None, dsm=None):
         """ Load data, run WOFS algorithm, attach metadata, and write output.
         
         Input: 
             - three-tuple of Tile objects (NBAR, PQ, DSM)
             - path object (output file destination)
+            - optionally, precomputed solar vector (see solar.attach_solar_vectors)
+            - optionally, neighbouring DSM tiles (for halo-aware terrain processing)
+            - optionally, the DSM tile already loaded (see load_dsm and perform_group)
         Output:
             - indexable object (referencing output data location)
         """        
-        if file_path.exists():
+        source, pq, dsm = self.load_task(loadables, file_path, solar_vector, dsm_neighbours, dsm)
+        
+        # Core computation
+        result = self.evaluate(source, pq, dsm)
+
+        return self.write_task(loadables, file_path, source, result)
+
+    def evaluate(self, source, pq, dsm):
+        """Core computation, evaluating a lazy result by scheduling its chunks on the task threads (see chunked)"""
+        result = self.core(source, pq, dsm)
+        if chunked.is_lazy(result.data):
+            result = result.compute(scheduler='threads', num_workers=self.threads)
+        return result
+
+    def output_path(self, file_path):
+        """Output destination in the configured format (see filename_template)"""
+        if self.output_format == 'zarr-stack': # i.e. timestamp suffix truncated to the year
+            prefix, stamp = file_path.stem.rsplit('_', 1)
+            return file_path.with_name(prefix + '_' + stamp[:4] + '.zarr')
+        return file_path.with_suffix('.zarr') if self.output_format == 'zarr' else file_path
+
+    def load_task(self, loadables, file_path, solar_vector=None, dsm_neighbours=None, dsm=None):
+        """Load the inputs (2D NBAR, PQ and DSM datasets) of a task (see perform_task)"""
+        file_path = self.output_path(file_path)
+        if self.output_format == 'zarr-stack':
+            if loadables[0].sources.time.values[0] in zarr_output.TimeStack(file_path):
+                raise OSError(errno.EEXIST, 'Acquisition already in stack', str(file_path))
+        elif file_path.exists():
             raise OSError(errno.EEXIST, 'Output file already exists', str(file_path))
             
-        # load data
+        terrain.THREADS = 1 if self.dask_chunks else self.threads # (lazily, chunks are parallel instead)
+        if self.shadow_tolerance and getattr(terrain_cache.shadows, 'tolerance', None) != self.shadow_tolerance:
+            terrain_cache.shadows = terrain_cache.ShadowCache(tolerance=self.shadow_tolerance) # per worker
+
+        # load data (lazily, if chunked)
         protosource, protopq, protodsm = loadables
         load = datacube.api.GridWorkflow.load
-        source = load(protosource, measurements=bands)
-        pq = load(protopq)
-        dsm = load(protodsm, resampling='cubic')
+        dask_chunks = dict(chunked.CHUNKS, y=self.dask_chunks, x=self.dask_chunks) if self.dask_chunks else None
+        source = load(protosource, measurements=bands, dask_chunks=dask_chunks)
+        pq = load(protopq, dask_chunks=dask_chunks)
+        if dsm is None:
+            dsm = self.load_dsm(protodsm)
+        if solar_vector is not None:
+            source.attrs['solar_vector'] = solar_vector
         
-        # Core computation
-        result = self.core(*(x.isel(time=0) for x in [source, pq, dsm]))
+        source, pq = (x.isel(time=0) for x in [source, pq])
+        if dsm_neighbours is not None: # extend by border strips of adjacent tiles
+            if solar_vector is None:
+                solar_vector = solar.solar_vectors([solar.tile_centre(protodsm.geobox)],
+                                                   protosource.sources.time.values[:1], protodsm.geobox.crs)[0]
+                source.attrs['solar_vector'] = solar_vector
+            widths = halo.halo_widths(solar_vector[3], solar_vector[4], dsm.elevation.shape)
+            dsm = halo.extend(dsm, dsm_neighbours, widths,
+                              load=lambda tile, rows, cols: load_strip(tile, rows, cols, store=self.dsm_store))
+        return source, pq, dsm
+
+    def write_task(self, loadables, file_path, source, result):
+        """Attach metadata to the result of a task, and write output (see perform_task)"""
+        protosource = loadables[0]
+        file_path = self.output_path(file_path)
         
         # Convert 2D DataArray to 3D DataSet
         result = xarray.concat([result], source.time).to_dataset(name='water')
@@ -249,12 +518,20 @@ class wofloven(datacube_application):
         # Provenance tracking
         allsources = [ds for tile in loadables for ds in tile.sources.values[0]]
 
+        # Reserve a time slice, if appending to a stack (indexed as a part of the stack)
+        uri = file_path.absolute().as_uri()
+        if self.output_format == 'zarr-stack':
+            stack = zarr_output.TimeStack(file_path)
+            layout = result.assign(dataset=(('time',), numpy.array([''], dtype=object))) # document is pending
+            part = stack.reserve(layout, global_attributes=self.global_attributes)
+            uri += '#part=%d' % part
+
         # Create indexable record
         new_record = datacube.model.utils.make_dataset(
                             product=self.product,
                             sources=allsources,
                             center_time=result.time.values[0],
-                            uri=file_path.absolute().as_uri(),
+                            uri=uri,
                             extent=box,
                             valid_data=envelope,
                             app_info=self.info )   
@@ -271,8 +548,14 @@ class wofloven(datacube_application):
         result['dataset'] = docvariable(new_record, result.time)
 
         # write output
-        datacube.storage.storage.write_dataset_to_netcdf(
-            result, file_path, global_attributes=self.global_attributes)
+        if self.output_format == 'zarr-stack':
+            stack.write(part, result, threads=self.threads)
+        elif self.output_format == 'zarr':
+            zarr_output.write_dataset_to_zarr(result, file_path, global_attributes=self.global_attributes,
+                                              threads=self.threads)
+        else:
+            datacube.storage.storage.write_dataset_to_netcdf(
+                result, file_path, global_attributes=self.global_attributes)
 
         return new_record
         
@@ -0,0 +1,72 @@
+"""
+Local snapshot of the catalogue, for incremental task discovery.
+
+A full discovery lists every NBAR, PQ and WOFL tile for the whole time range (and the
+DSM tile set, which never changes). The snapshot instead keeps the DSM tiles, the keys
+(x, y, time, platform) of every task already generated, and a high-water mark of
+acquisition time for each platform. Later runs then query only acquisitions after the
+high-water mark (less a lookback window, to catch scenes indexed late), and skip any
+already generated, so daily top-up runs are cheap.
+
+(The datacube query API does not filter by indexing time, hence acquisition time.)
+The high-water mark only advances once a discovery completes (e.g. not if truncated),
+and is kept per requested time range (e.g. per year prepared), so that preparing an
+earlier range after a later one still queries the whole of it.
+"""
+
+import datetime
+import os
+import pickle
+import tempfile
+import pandas
+
+class Catalogue(object):
+    """Snapshot of task discovery, persisted to a (pickle) file"""
+    def __init__(self, path, lookback_days=30):
+        self.path = path
+        self.lookback = datetime.timedelta(days=lookback_days)
+        self.state = {'extent': None, 'dsm': None, 'seen': set(), 'high_water': {}}
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                self.state = pickle.load(f)
+        self.pending = {}
+    def reset(self, extent):
+        """Discard the snapshot if made for a different spatial extent"""
+        if self.state['extent'] != extent:
+            self.state = {'extent': dict(extent), 'dsm': None, 'seen': set(), 'high_water': {}}
+    def dsm_tiles(self, query):
+        """DSM tiles (from the snapshot, or else by calling query)"""
+        if self.state['dsm'] is None:
+            self.state['dsm'] = query()
+        return self.state['dsm']
+    @staticmethod
+    def _mark(platform, time):
+        """Key of a high-water mark (i.e. platform and requested time range)"""
+        return platform, tuple(pandas.to_datetime(t).isoformat() for t in time)
+    def window(self, platform, time):
+        """Time range to query for new acquisitions of the platform"""
+        start, end = time
+        high_water = self.state['high_water'].get(self._mark(platform, time))
+        if high_water is not None:
+            start = max(pandas.to_datetime(start), high_water - self.lookback).isoformat()
+        return start, end
+    def is_new(self, key):
+        return key not in self.state['seen']
+    def record(self, key):
+        """Note a task as generated"""
+        self.state['seen'].add(key)
+        platform, t = key[3], pandas.to_datetime(key[2])
+        self.pending[platform] = max(self.pending.get(platform, t), t)
+    def complete(self, time):
+        """Advance the high-water marks for the time range (once discovery has generated every task)"""
+        for platform, t in self.pending.items():
+            mark = self._mark(platform, time)
+            self.state['high_water'][mark] = max(self.state['high_water'].get(mark, t), t)
+        self.pending = {}
+    def save(self):
+        """Write atomically (lest an interrupted run corrupt the snapshot)"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, temporary = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, 'wb') as f:
+            pickle.dump(self.state, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temporary, self.path)
@@ -0,0 +1,77 @@
+"""
+Lazy (dask) execution of the WOFL algorithm, over chunks rather than whole tiles in memory.
+
+Inputs loaded as dask arrays (e.g. GridWorkflow.load with dask_chunks) are processed chunk by chunk,
+so that tiles larger than memory (or many tiles at once) run with bounded memory, and chunks may be
+scheduled in parallel. Neighbourhood operations use map_overlap, with each chunk extended by the
+reach of the operation and cropped back afterwards:
+    - the per-pixel classification and filters, by the PQ dilation (see blockwise);
+    - the terrain filter, by the Sobel radius and shadow dilation (halo.MARGIN),
+      plus the longest possible shadow on sunward sides (see halo.halo_widths),
+      plus the border that shadow casting itself leaves unreliable (SHADOW_EDGE).
+Chunks at the tile edges are not padded (boundary='none'), so the blockwise part reproduces
+whole-tile results exactly. The terrain shadows of each chunk are cast from its extended block
+(as for the halo mode), so may differ from whole-tile shadows by resampling, chiefly near tile edges.
+"""
+
+import numpy as np
+import constants
+import blockwise
+import halo
+import terrain_greg as terrain
+from dilation import dilate
+
+CHUNKS = {'time': 1, 'y': 200, 'x': 200} # as for the product storage (see product_definition.yaml)
+TERRAIN_CHUNK = 1000 # pixels, amortising the (potentially long) shadow halo
+SHADOW_EDGE = 4 # pixels, at block edges where shadow casting is unreliable (e.g. rotation resampling)
+
+def is_lazy(array):
+    """Whether an array is a dask array (rather than numpy)"""
+    return hasattr(array, 'dask')
+
+def woffles_blockwise(bands, nodata, pq, dilation=3):
+    """Lazy equivalent of blockwise.woffles_blockwise, over the chunks of the PQ array"""
+    import dask.array
+
+    bands = [dask.array.asarray(band).rechunk(pq.chunks) for band in bands]
+    def block(pq, *bands):
+        return blockwise.woffles_blockwise(bands, nodata, pq, dilation=dilation)
+    return dask.array.map_overlap(block, pq, *bands, depth=dilation, boundary='none', dtype=np.uint8)
+
+def terrain_filter(dsm, nbar, shadow_method='rotate', chunk=TERRAIN_CHUNK):
+    """
+    Lazy equivalent of filters.terrain_filter, over chunks of the DSM.
+
+    The solar vector is that of the whole tile (see terrain.tile_solar_vector), for consistency
+    between chunks. A DSM extended by a halo (see halo module) is cropped back afterwards.
+    """
+    import dask.array
+
+    solar_vec = nbar.attrs.get('solar_vector')
+    if solar_vec is None:
+        solar_vec = terrain.tile_solar_vector(dsm, nbar.blue.time.values)
+    sun_az, sun_alt = solar_vec[3], solar_vec[4]
+    x_scale, y_scale = abs(8*dsm.affine.a), abs(8*dsm.affine.e)
+    pixel_scale_M = 25.0 # as for terrain.terrain_shadows
+
+    elevation = dsm.elevation.data
+    if not is_lazy(elevation): # e.g. memory-mapped from the DSM store, so read per chunk
+        elevation = dask.array.from_array(elevation, chunks=chunk)
+    top, bottom, left, right = [width + SHADOW_EDGE for width in
+                                halo.halo_widths(sun_az, sun_alt, elevation.shape, pixel_scale_M)]
+
+    def block(elevation):
+        elevation = np.asarray(elevation, dtype=np.float32)
+        shadows = terrain.SHADOW_METHODS[shadow_method](elevation, sun_az, sun_alt,
+                                                        pixel_scale_M, halo.NO_DATA, fuzz=10.0)
+        steep, dim = terrain.elevation_masks(elevation, x_scale, y_scale, solar_vec,
+                                             constants.SLOPE_THRESHOLD_DEGREES,
+                                             constants.LOW_SOLAR_INCIDENCE_THRESHOLD_DEGREES)
+        shadowy = dilate(shadows != terrain.LIT) | dim
+        return np.uint8(constants.MASKED_TERRAIN_SHADOW) * shadowy | np.uint8(constants.MASKED_HIGH_SLOPE) * steep
+
+    masking = dask.array.map_overlap(block, elevation, depth={0: (top, bottom), 1: (left, right)},
+                                     boundary='none', dtype=np.uint8)
+    if 'halo' in dsm.attrs:
+        masking = halo.crop(masking, dsm.attrs['halo'])
+    return masking
@@ -3,6 +3,8 @@
 import numpy
 import logging
 import gc
+import math
+import fractions
 #import argparse
 #from osgeo import gdal
 
@@ -216,3 +218,279 @@ def classify(images, float64=False):
     logger.debug("completed")
 
     return classified
+
+
+BLOCK_PIXELS = 2**16 # working set per block (i.e. a few hundred KB per float32 temporary)
+
+def _branch(test, left, right):
+    """
+    Select left where test holds, otherwise right, for boolean arrays (or constant leaves).
+
+    Expressed in bitwise logic (which numpy vectorises far better than numpy.where),
+    simplifying wherever a branch terminates in a constant leaf.
+    """
+    if left is True:
+        return test if right is False else test | right
+    if left is False:
+        return ~test if right is True else ~test & right
+    if right is True:
+        return ~test | left
+    if right is False:
+        return test & left
+    return (test & left) | (~test & right)
+
+# N.Mueller's decision tree (as diagrammed in classify) as a node table:
+#     node : (feature, threshold, left, right, leaf value)
+# Branch nodes test (feature <= threshold), proceeding to the left node if true, else the right.
+# Leaf nodes have no feature, and a value of 128 (water) or 0 (no water).
+# Features are raw bands b1, b3, b7 or normalised ratio indices ndi_52, ndi_43, ndi_72.
+WOFS_TREE = {
+    1:  ('ndi_52', -0.01,  2,  21, None),
+    2:  ('b1',     2083.5, 4,  3,  None),
+    3:  (None,     None,   None, None, 0),
+    4:  ('b7',     323.5,  5,  8,  None),
+    5:  ('ndi_43', 0.61,   6,  7,  None),
+    6:  (None,     None,   None, None, 128),
+    7:  (None,     None,   None, None, 0),
+    8:  ('b1',     1400.5, 12, 9,  None),
+    9:  ('ndi_43', -0.01,  10, 11, None),
+    10: (None,     None,   None, None, 128),
+    11: (None,     None,   None, None, 0),
+    12: ('ndi_72', -0.23,  16, 13, None),
+    13: ('b1',     379,    14, 15, None),
+    14: (None,     None,   None, None, 128),
+    15: (None,     None,   None, None, 0),
+    16: ('ndi_43', 0.22,   17, 18, None),
+    17: (None,     None,   None, None, 128),
+    18: ('b1',     473,    19, 20, None),
+    19: (None,     None,   None, None, 128),
+    20: (None,     None,   None, None, 0),
+    21: ('ndi_52', 0.23,   22, 35, None),
+    22: ('b1',     334.5,  24, 23, None),
+    23: (None,     None,   None, None, 0),
+    24: ('ndi_43', 0.54,   26, 25, None),
+    25: (None,     None,   None, None, 0),
+    26: ('ndi_52', 0.12,   27, 28, None),
+    27: (None,     None,   None, None, 128),
+    28: ('b3',     364.5,  29, 30, None),
+    29: ('b1',     129.5,  31, 32, None),
+    30: ('b1',     300.5,  33, 34, None),
+    31: (None,     None,   None, None, 128),
+    32: (None,     None,   None, None, 0),
+    33: (None,     None,   None, None, 128),
+    34: (None,     None,   None, None, 0),
+    35: ('ndi_52', 0.34,   37, 36, None),
+    36: (None,     None,   None, None, 0),
+    37: ('b1',     249.5,  39, 38, None),
+    38: (None,     None,   None, None, 0),
+    39: ('ndi_43', 0.45,   41, 40, None),
+    40: (None,     None,   None, None, 0),
+    41: ('b3',     364.5,  43, 42, None),
+    42: (None,     None,   None, None, 0),
+    43: ('b1',     129.5,  44, 45, None),
+    44: (None,     None,   None, None, 128),
+    45: (None,     None,   None, None, 0)}
+
+FEATURES = ['b1', 'b3', 'b7', 'ndi_52', 'ndi_43', 'ndi_72']
+
+def _walk(tree, leaf, branch, node=1):
+    """Fold the node table from the root, combining leaf values and branch nodes bottom-up."""
+    feature, threshold, left, right, value = tree[node]
+    if feature is None:
+        if value not in (0, 128):
+            raise ValueError("Leaf node %s must be 0 or 128, not %r" % (node, value))
+        return leaf(value == 128)
+    if feature not in FEATURES:
+        raise ValueError("Node %s tests unknown feature %r" % (node, feature))
+    return branch(feature, threshold, _walk(tree, leaf, branch, left), _walk(tree, leaf, branch, right))
+
+def compile_tree(tree=WOFS_TREE):
+    """
+    Compile a node table into a function of a predicate le(feature, threshold),
+    returning a boolean array that is true where water is classified.
+
+    The table is validated and flattened into nested closures once, so that the
+    evaluation of each block is a single bitwise-logic expression.
+    """
+    def leaf(wet):
+        return wet # constant, for _branch to simplify
+    def branch(feature, threshold, left, right):
+        resolve = lambda side, le: side if isinstance(side, bool) else side(le)
+        return lambda le: _branch(le(feature, threshold), resolve(left, le), resolve(right, le))
+    decide = _walk(tree, leaf, branch)
+    if isinstance(decide, bool):
+        raise ValueError("Tree has no branch nodes")
+    return decide
+
+def tree_expression(tree=WOFS_TREE):
+    """
+    Compile a node table into a (multi-line) numexpr boolean expression, and its thresholds.
+
+    Thresholds are returned as named variables (t0, t1, ..) rather than inlined as literals,
+    since numexpr would otherwise promote float32 comparisons to float64.
+    """
+    thresholds = []
+    def leaf(wet):
+        return wet
+    def branch(feature, threshold, left, right):
+        name = 't%d' % len(thresholds)
+        thresholds.append(threshold)
+        test = '(%s <= %s)' % (feature, name)
+        indent = lambda side: side.replace('\n', '\n    ') if isinstance(side, str) else side
+        left, right = indent(left), indent(right)
+        if left is True:
+            return test if right is False else '%s |\n    (%s)' % (test, right)
+        if left is False:
+            return '~%s' % test if right is True else '~%s &\n    (%s)' % (test, right)
+        if right is True:
+            return '~%s |\n    (%s)' % (test, left)
+        if right is False:
+            return '%s &\n    (%s)' % (test, left)
+        return '(%s &\n    (%s)) |\n(~%s &\n    (%s))' % (test, left, test, right)
+    expression = _walk(tree, leaf, branch)
+    if isinstance(expression, bool):
+        raise ValueError("Tree has no branch nodes")
+    return '(%s)' % expression, thresholds
+
+_decide = compile_tree(WOFS_TREE)
+
+def _float_features(images, dtype):
+    """Lazily derive the tree features (raw bands and normalised ratio indices) from a block."""
+    images = images.astype(dtype, copy=False)
+    b1, b2, b3, b4, b5, b7 = images
+    features = {'b1': lambda: b1,
+                'b3': lambda: b3,
+                'b7': lambda: b7,
+                'ndi_52': lambda: (b5 - b2) / (b5 + b2),
+                'ndi_43': lambda: (b4 - b3) / (b4 + b3),
+                'ndi_72': lambda: (b7 - b2) / (b7 + b2)}
+    cache = {}
+    def le(name, threshold):
+        if name not in cache:
+            cache[name] = features[name]()
+        return cache[name] <= threshold
+    return le
+
+def _ratio_bound(threshold):
+    """
+    Exact rational equivalent (numerator, denominator) of a float32 test (ndi <= threshold).
+
+    For integer bands, ndi = d/s is rounded once (d and s being exact in float32), so the test
+    passes precisely when the true ratio lies below the midpoint between float32(threshold)
+    and the next float32 above it. That midpoint is a dyadic rational whose denominator far
+    exceeds any int16 band sum, so the ratio can never land exactly on it.
+    """
+    t = numpy.float32(threshold)
+    above = numpy.nextafter(t, numpy.float32(numpy.inf))
+    bound = fractions.Fraction((float(t) + float(above)) / 2)
+    return bound.numerator, bound.denominator
+
+def _integer_features(images):
+    """
+    Tree predicates for a block of raw integer bands, never converting to float.
+
+    Ratio tests (a-b)/(a+b) <= t are cross-multiplied (in int64), taking care with the sign
+    of the denominator, and zero denominators follow the float semantics (i.e. -inf passes,
+    +inf and nan fail). Results match the default float32 path of classify exactly.
+    """
+    b1, b2, b3, b4, b5, b7 = images
+    bands = {'b1': b1, 'b3': b3, 'b7': b7}
+    ratios = {'ndi_52': (b5, b2), 'ndi_43': (b4, b3), 'ndi_72': (b7, b2)}
+    cache = {}
+    def terms(name):
+        if name not in cache:
+            a, b = ratios[name]
+            a = a.astype(numpy.int64)
+            b = b.astype(numpy.int64)
+            cache[name] = a - b, a + b
+        return cache[name]
+    def le(name, threshold):
+        if name in bands:
+            return bands[name] <= int(math.floor(threshold))
+        d, s = terms(name)
+        numerator, denominator = _ratio_bound(threshold)
+        lhs = d * denominator
+        rhs = s * numerator
+        return ((s > 0) & (lhs < rhs)) | ((s < 0) & (lhs > rhs)) | ((s == 0) & (d < 0))
+    return le
+
+def _row_blocks(rows, cols, block_rows=None):
+    """Yield slices covering the rows, each of block_rows (by default, about BLOCK_PIXELS pixels)"""
+    if block_rows is None:
+        block_rows = max(1, BLOCK_PIXELS // max(cols, 1))
+    for start in range(0, rows, block_rows):
+        yield slice(start, start + block_rows)
+
+def classify_blockwise(images, float64=False, block_rows=None, integer=False, tree=WOFS_TREE):
+    """
+    Produce the same water classification as classify, but in a single pass over blocks of rows.
+
+    Each block is converted to float (following the same dtype rules as classify), its features
+    derived, and the whole tree evaluated before the result is written directly into the output.
+    Peak working memory is therefore proportional to the block rather than to the tile.
+
+    :param images:
+        A 3D numpy array ordered in (bands,rows,columns), as for classify.
+
+    :param float64:
+        As for classify.
+
+    :param block_rows:
+        Number of image rows per block. Default sizes blocks to roughly BLOCK_PIXELS pixels.
+
+    :param integer:
+        Boolean keyword. If set to True then integer (e.g. int16 NBAR) bands are compared by
+        cross-multiplication instead of being converted to float, reproducing the float32 result
+        exactly. Not compatible with float64 or with floating point input. Default is False.
+
+    :param tree:
+        Node table of the decision tree (see WOFS_TREE), e.g. for a retrained threshold set.
+
+    :return:
+        A 2D numpy array of type UInt8, bit-identical to the output of classify.
+    """
+    decide = _decide if tree is WOFS_TREE else compile_tree(tree)
+
+    if integer:
+        if float64 or not numpy.issubdtype(images.dtype, numpy.integer):
+            raise ValueError("Integer mode requires integer bands and reproduces float32 only")
+        features = _integer_features
+    elif float64 or images.dtype == 'float64':
+        features = lambda block: _float_features(block, numpy.float64)
+    else:
+        features = lambda block: _float_features(block, numpy.float32)
+
+    bands, rows, cols = images.shape
+    classified = numpy.empty((rows, cols), dtype='uint8')
+
+    for block in _row_blocks(rows, cols, block_rows):
+        wet = decide(features(images[:, block]))
+        numpy.left_shift(wet.view(numpy.uint8), 7, out=classified[block]) # True -> 128
+
+    return classified
+
+def classify_numexpr(images, float64=False, block_rows=None, tree=WOFS_TREE):
+    """
+    Produce the same water classification as classify_blockwise, evaluating the tree with numexpr.
+
+    The node table is compiled to a single boolean expression (see tree_expression), which numexpr
+    evaluates in one multithreaded pass over the features of each block. Requires numexpr.
+    """
+    import numexpr
+
+    dtype = numpy.float64 if float64 or images.dtype == 'float64' else numpy.float32
+    expression, thresholds = tree_expression(tree)
+    thresholds = {'t%d' % i: dtype(t) for i, t in enumerate(thresholds)}
+
+    bands, rows, cols = images.shape
+    classified = numpy.empty((rows, cols), dtype='uint8')
+
+    for block in _row_blocks(rows, cols, block_rows):
+        b1, b2, b3, b4, b5, b7 = images[:, block].astype(dtype, copy=False)
+        features = dict(zip(FEATURES, [b1, b3, b7,
+                                       (b5 - b2) / (b5 + b2), (b4 - b3) / (b4 + b3), (b7 - b2) / (b7 + b2)]))
+        features.update(thresholds)
+        wet = numexpr.evaluate(expression, local_dict=features)
+        numpy.left_shift(wet.view(numpy.uint8), 7, out=classified[block])
+
+    return classified
@@ -0,0 +1,47 @@
+"""
+Blocky (square) dilation of bitfield flag planes.
+
+Iterating a 3x3 square dilation n times is equivalent to a single (2n+1)x(2n+1) square,
+which is separable into a running maximum along each axis. For bitfields, the running
+maximum of each plane is a bitwise OR over the window, so all planes of a uint8 flag
+array are dilated together by a handful of shifted ORs (rather than by a morphology
+pass per plane).
+
+Pixels beyond the array edges are treated as unflagged, as for scipy.ndimage.binary_dilation.
+"""
+
+import numpy as np
+
+def _running_or(array, radius, axis):
+    """Bitwise OR over a window of +/- radius along one axis (in place, returning the array)"""
+    source = array.copy()
+    n = array.shape[axis]
+    def part(a, start, stop):
+        index = [slice(None)] * a.ndim
+        index[axis] = slice(start, stop)
+        return a[tuple(index)]
+    for k in range(1, min(radius, n - 1) + 1):
+        part(array, k, n)[...] |= part(source, 0, n - k)
+        part(array, 0, n - k)[...] |= part(source, k, n)
+    return array
+
+def dilate_bits(flags, bits, dilation=3):
+    """
+    Dilate selected planes of a uint8 bitfield in one pass.
+
+    :param flags: 2D uint8 bitfield array
+    :param bits: mask of the planes to dilate (e.g. MASKED_CLOUD | MASKED_CLOUD_SHADOW)
+    :param dilation: iterations of 3x3 square dilation
+    :return: new uint8 array, with the selected planes dilated and other planes unchanged
+    """
+    bits = np.uint8(bits)
+    planes = flags & bits
+    if dilation:
+        _running_or(planes, dilation, axis=0)
+        _running_or(planes, dilation, axis=1)
+    return flags | planes
+
+def dilate(array, dilation=3):
+    """Dilate a boolean mask, by treating it as a single plane bitfield"""
+    mask = np.asarray(array, dtype=np.bool_)
+    return dilate_bits(mask.view(np.uint8), 1, dilation).view(np.bool_)
@@ -0,0 +1,83 @@
+"""
+Executor backends for streaming tasks through compute resources (see map_orderless).
+
+Backends are selected by name (thread or distributed); threads need no scheduler (and avoid
+the slow import of distributed), so that a single node can be used without a dask cluster.
+There is no plain process pool backend, as tasks are bound methods of the application, whose
+core (defined in a __main__ script) only distributed can serialise (by value, with cloudpickle).
+
+Completed futures are collected through a queue (fed by completion callbacks), so the
+bookkeeping per task is constant rather than proportional to the backlog.
+
+The backlog (tasks in flight) adapts to observed task durations and completion rate:
+by Little's law their product estimates the number of busy workers, and the backlog is
+kept a margin above that (within the configured maximum).
+"""
+
+import itertools
+import math
+import multiprocessing
+import time
+try:
+    import queue
+except ImportError: # python 2
+    import Queue as queue
+import concurrent.futures
+
+def thread_executor(workers=None):
+    return concurrent.futures.ThreadPoolExecutor(workers or multiprocessing.cpu_count())
+
+def distributed_executor(workers=None):
+    import distributed # slow import
+    return distributed.Client(**({'n_workers': workers} if workers else {}))
+
+BACKENDS = {'thread': thread_executor, 'distributed': distributed_executor}
+
+class Backlog(object):
+    """Adaptive limit on tasks in flight"""
+    def __init__(self, maximum=50, initial=None, slack=2.0, smoothing=0.2):
+        self.maximum = maximum
+        self.limit = min(maximum, initial or maximum)
+        self.slack = slack
+        self.smoothing = smoothing
+        self.duration = self.interval = None # smoothed estimates (seconds)
+        self.last = time.time()
+    def _smooth(self, estimate, observation):
+        return observation if estimate is None else estimate + self.smoothing * (observation - estimate)
+    def observe(self, duration):
+        """Update from a completed task (of given duration)"""
+        now = time.time()
+        self.duration = self._smooth(self.duration, duration)
+        self.interval = self._smooth(self.interval, now - self.last)
+        self.last = now
+        busy = self.duration / max(self.interval, 1e-6) # Little's law
+        self.limit = int(max(1, min(self.maximum, math.ceil(self.slack * busy) + 1)))
+
+def _timed(core, args):
+    """Call the core, also returning its duration (measured by the worker, excluding queueing)"""
+    start = time.time()
+    result = core(*args)
+    return result, time.time() - start
+
+def map_orderless(core, tasks, executor, backlog):
+    """Yield results of core(*task) for each task, in order of completion"""
+    tasks = iter(tasks)
+    done = queue.Queue()
+    inflight = [0]
+
+    def submit(task):
+        future = executor.submit(_timed, core, task)
+        inflight[0] += 1
+        future.add_done_callback(done.put)
+
+    for task in itertools.islice(tasks, backlog.limit): # pre-fill queue
+        submit(task)
+
+    while inflight[0]:
+        future = done.get() # block
+        inflight[0] -= 1
+        result, duration = future.result() # unwrap future
+        backlog.observe(duration)
+        for task in itertools.islice(tasks, max(0, backlog.limit - inflight[0])):
+            submit(task) # queue more
+        yield result
@@ -6,12 +6,35 @@ import constants
 import numpy as np
 import scipy.ndimage 
 import terrain_greg as terrain
-
-def dilate(array, dilation=3):
-    """Blocky dilation e.g. for cloud and cloud/terrain shadow"""
+import terrain_cache
+import halo
+from dilation import dilate, dilate_bits # blocky dilation e.g. for cloud and cloud/terrain shadow
+
+def dilate_scipy(array, dilation=3):
+    """Original blocky dilation by scipy morphology (retained for comparison)"""
+    if not dilation: # (scipy would otherwise iterate until unchanging)
+        return np.asarray(array, dtype=np.bool_)
     return scipy.ndimage.binary_dilation(array, iterations=dilation, structure=[[1]*3]*3)
 
-def pq_filter(pq):
+PQA_SATURATION_BITS = sum(2**n for n in [0,1,2,3,4,7]) # exclude thermal
+#PQA_CONTIGUITY_BITS = 0x01FF
+PQA_CLOUD_BITS = 0x0C00
+PQA_CLOUD_SHADOW_BITS = 0x3000
+PQA_SEA_WATER_BIT = 0x0200
+
+def _pq_lookup_table():
+    """WOFL flags (prior to dilation) for every possible 16-bit PQ word"""
+    pq = np.arange(2**16, dtype=np.uint32)
+    table = np.zeros(pq.shape, dtype=np.uint8)
+    table |= np.uint8(constants.MASKED_NO_CONTIGUITY) * np.logical_not(pq & PQA_SATURATION_BITS)
+    table |= np.uint8(constants.MASKED_SEA_WATER) * np.logical_not(pq & PQA_SEA_WATER_BIT)
+    table |= np.uint8(constants.MASKED_CLOUD) * np.logical_not(pq & PQA_CLOUD_BITS)
+    table |= np.uint8(constants.MASKED_CLOUD_SHADOW) * np.logical_not(pq & PQA_CLOUD_SHADOW_BITS)
+    return table
+
+PQ_LOOKUP = _pq_lookup_table()
+
+def pq_filter(pq, dilation=3):
     """
     Propagate flags from the pixel quality product.
 
@@ -29,39 +52,65 @@ def pq_filter(pq):
     Notes:
         - will output same flag to indicate noncontiguity, oversaturation and undersaturation.
         - disregarding PQ contiguity flag (see eo_filter instead) to exclude thermal bands.
-        - permitting simultaneous flags (through addition syntax) since constants happen to be 
-          different powers of the same base.
+        - permitting simultaneous flags.
         - dilates the cloud and cloud shadow. (Previous implementation eroded the negation.)
-        - input must be numpy not xarray.DataArray (due to depreciated boolean fancy indexing behaviour)
+        - input must be numpy not xarray.DataArray.
+        - decodes each PQ word by a single gather from a 65536 entry lookup table,
+          then dilates the cloud and cloud shadow planes of the bitfield together.
     """
 
-    PQA_SATURATION_BITS = sum(2**n for n in [0,1,2,3,4,7]) # exclude thermal
-    #PQA_CONTIGUITY_BITS = 0x01FF
-    PQA_CLOUD_BITS = 0x0C00
-    PQA_CLOUD_SHADOW_BITS = 0x3000
-    PQA_SEA_WATER_BIT = 0x0200
+    words = pq.view(np.uint16) if pq.dtype.itemsize == 2 else pq.astype(np.uint16) # low 16 bits
+    masking = PQ_LOOKUP[words]
+    return dilate_bits(masking, constants.MASKED_CLOUD | constants.MASKED_CLOUD_SHADOW, dilation)
+
+def pq_filter_bitwise(pq, dilation=3):
+    """
+    Original implementation of pq_filter, by four masked bitwise passes (retained for comparison).
 
+    Input must be numpy not xarray.DataArray (due to depreciated boolean fancy indexing behaviour).
+    """
     masking = np.zeros(pq.shape, dtype=np.uint8) 
     masking[np.logical_not(pq & (PQA_SATURATION_BITS | 0))] = constants.MASKED_NO_CONTIGUITY
     masking[np.logical_not(pq & PQA_SEA_WATER_BIT)] += constants.MASKED_SEA_WATER
-    masking[dilate(np.logical_not(pq & PQA_CLOUD_BITS))] += constants.MASKED_CLOUD
-    masking[dilate(np.logical_not(pq & PQA_CLOUD_SHADOW_BITS))] += constants.MASKED_CLOUD_SHADOW
+    masking[dilate_scipy(np.logical_not(pq & PQA_CLOUD_BITS), dilation)] += constants.MASKED_CLOUD
+    masking[dilate_scipy(np.logical_not(pq & PQA_CLOUD_SHADOW_BITS), dilation)] += constants.MASKED_CLOUD_SHADOW
     return masking
 
-def terrain_filter(dsm, nbar):
+def terrain_filter(dsm, nbar, shadow_method='rotate', cache=None, shadow_cache=None):
     """
     Terrain shadow masking, slope masking, solar incidence angle masking.
+    (The slope and incidence masks are thresholded directly, see terrain.terrain_masks.)
 
     Input: xarray DataSets
+
+    The shadow_method selects the terrain shadow algorithm (see terrain.SHADOW_METHODS).
+    Time-invariant terrain gradients are reused from the cache (by default, terrain_cache.shared),
+    unless it is disabled (maxsize 0, without a directory), when they are computed in bands instead.
+    Optionally, shadow masks are memoised by quantised sun position (see terrain_cache.ShadowCache,
+    by default terrain_cache.shadows).
+    Uses the solar vector attached to the EO data, if precomputed (see solar module).
+    A DSM extended by a halo from neighbouring tiles is cropped back afterwards (see halo module).
     """
 
-    shadows, slope, sia = terrain.shadows_and_slope(dsm, nbar.blue.time.values)
+    cache = cache or terrain_cache.shared
+    shadow_cache = shadow_cache or terrain_cache.shadows
+    solar_vec = nbar.attrs.get('solar_vector')
+    if solar_vec is None:
+        solar_vec = terrain.tile_solar_vector(dsm, nbar.blue.time.values)
+
+    shadows = terrain.terrain_shadows(dsm, solar_vec, shadow_method, shadow_cache=shadow_cache)
+
+    steep, dim = terrain.terrain_masks(dsm, solar_vec, constants.SLOPE_THRESHOLD_DEGREES,
+                                       constants.LOW_SOLAR_INCIDENCE_THRESHOLD_DEGREES,
+                                       gradients=cache.get(dsm) if cache.maxsize or cache.directory else None)
 
-    shadowy = dilate(shadows != terrain.LIT) | (sia < constants.LOW_SOLAR_INCIDENCE_THRESHOLD_DEGREES)
+    shadowy = dilate(shadows != terrain.LIT) | dim
 
-    steep = (slope > constants.SLOPE_THRESHOLD_DEGREES)
+    masking = np.uint8(constants.MASKED_TERRAIN_SHADOW) * shadowy | np.uint8(constants.MASKED_HIGH_SLOPE) * steep
 
-    return np.uint8(constants.MASKED_TERRAIN_SHADOW) * shadowy | np.uint8(constants.MASKED_HIGH_SLOPE) * steep
+    if 'halo' in dsm.attrs:
+        masking = halo.crop(np.asarray(masking), dsm.attrs['halo'])
+    return masking
 
 
 def eo_filter(source):
@@ -72,10 +121,25 @@ def eo_filter(source):
 
     Contiguity can easily be tested either here or using PQ.
     """
-    nodata_bools = source.apply(lambda array: array == array.nodata).to_array(dim='band')
+    bands = [source[name] for name in source.data_vars]
+    return nodata_filter([band.data for band in bands], [band.nodata for band in bands])
 
-    nothingness = nodata_bools.all(dim='band')
-    noncontiguous = nodata_bools.any(dim='band')
+def nodata_filter(arrays, nodata):
+    """
+    Flag where all (no data) or any (noncontiguous) of the bands are missing.
 
-    return np.uint8(constants.NO_DATA) * nothingness | np.uint8(constants.MASKED_NO_CONTIGUITY) * noncontiguous
+    Streams over the numpy bands, comparing each to its own nodata value, and
+    accumulates the two reductions in place (rather than stacking the comparisons).
+    """
+    assert len(arrays) == len(nodata) > 0
 
+    missing = np.empty(np.shape(arrays[0]), dtype=np.bool_)
+    nothingness = np.ones_like(missing)
+    noncontiguous = np.zeros_like(missing)
+
+    for array, value in zip(arrays, nodata):
+        np.equal(array, value, out=missing)
+        nothingness &= missing
+        noncontiguous |= missing
+
+    return np.uint8(constants.NO_DATA) * nothingness | np.uint8(constants.MASKED_NO_CONTIGUITY) * noncontiguous
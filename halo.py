@@ -0,0 +1,125 @@
+"""
+Halo-aware terrain processing, using border strips from neighbouring DSM tiles.
+
+Terrain shadows (and the Sobel gradients and dilations) computed per tile lack context
+beyond the tile edge, causing edge artefacts. Rather than loading the 3x3 surrounding
+DSM tiles (nine times the I/O), only the border strips that can matter are loaded:
+a margin for the Sobel and dilation kernels on every side, widened on the sunward sides
+to the longest shadow that the terrain relief could cast at the sun altitude.
+
+Strip widths are rounded up (to STRIP_QUANTUM), so that a strip loaded for one acquisition
+can be reused (from the StripCache) by later tasks for the same or adjacent tiles.
+"""
+
+import collections
+import math
+import threading
+import numpy
+import xarray
+
+MAX_RELIEF_M = 2500.0 # bounds the height of any shadow-casting terrain above its surroundings
+MARGIN = 4 # pixels, for Sobel (1) and dilation (3)
+STRIP_QUANTUM = 64 # pixels
+NO_DATA = -1000 # as for terrain_greg shading
+
+def halo_widths(sun_az, sun_alt, shape, pixel_scale_M=25.0, max_relief_M=MAX_RELIEF_M, margin=MARGIN):
+    """
+    Halo (top, bottom, left, right) in pixels for a tile of given shape.
+
+    Sunward sides receive the longest possible shadow length, and all sides the kernel margin.
+    Azimuth is relative to grid north (as returned by terrain_greg.solar_vector).
+    """
+    rows, cols = shape
+    if sun_alt > 0:
+        length = max_relief_M / math.tan(sun_alt) / pixel_scale_M
+    else:
+        length = max(rows, cols)
+    towards_sun_col, towards_sun_row = math.sin(sun_az), -math.cos(sun_az)
+    def width(component, limit):
+        reach = length * component
+        if reach < 0.5: # pixel
+            return margin
+        reach = int(math.ceil((margin + reach) / float(STRIP_QUANTUM))) * STRIP_QUANTUM
+        return min(limit, reach)
+    return (width(-towards_sun_row, rows), width(towards_sun_row, rows),
+            width(-towards_sun_col, cols), width(towards_sun_col, cols))
+
+class StripCache(object):
+    """Least-recently-used cache of strips loaded from neighbouring DSM tiles."""
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.memory = collections.OrderedDict()
+        self.hits = self.misses = 0
+        self.lock = threading.Lock() # (tasks may run on threads, see executors)
+    def get(self, tile_index, rows, cols, load):
+        """
+        Elevation of the (rows, cols) slices of a DSM tile, where load(rows, cols) reads them.
+
+        Served from any cached strip of the same tile that contains the requested region.
+        """
+        with self.lock:
+            for key in list(self.memory):
+                index, (row0, row1), (col0, col1) = key
+                if index == tile_index and row0 <= rows.start and rows.stop <= row1 \
+                        and col0 <= cols.start and cols.stop <= col1:
+                    self.hits += 1
+                    strip = self.memory.pop(key)
+                    self.memory[key] = strip # most recently used
+                    return strip[rows.start - row0:rows.stop - row0, cols.start - col0:cols.stop - col0]
+            self.misses += 1
+        strip = load(rows, cols) # (without the lock)
+        with self.lock:
+            if self.maxsize > 0:
+                self.memory[(tile_index, (rows.start, rows.stop), (cols.start, cols.stop))] = strip
+                while len(self.memory) > self.maxsize:
+                    self.memory.popitem(last=False)
+        return strip
+
+shared = StripCache() # per worker process
+
+def _parts(offset, width, size):
+    """Slices (of the neighbour, and of the extended array) for a tile index offset along one axis"""
+    before, after = width
+    if offset == 0:
+        return slice(0, size), slice(before, before + size)
+    if offset < 0:
+        return slice(size - before, size), slice(0, before)
+    return slice(0, after), slice(before + size, before + size + after)
+
+def extend(dsm, neighbours, widths, load, cache=None):
+    """
+    Extend a DSM tile (2D xarray Dataset) by a halo taken from neighbouring tiles.
+
+    :param neighbours: {(dx, dy): (tile_index, tile)} for available neighbours, where dy>0 is north
+    :param widths: halo (top, bottom, left, right) in pixels (see halo_widths)
+    :param load: function (tile, rows, cols) returning a 2D elevation array
+    :return: Dataset of the extended elevation (the tile edge replicated where a neighbour is unavailable),
+             with the halo recorded (in attrs) for cropping results back to the tile.
+    """
+    cache = cache or shared
+    top, bottom, left, right = widths
+    rows, cols = dsm.elevation.shape
+
+    # where a neighbour is unavailable (e.g. coast, or query extent), replicate the tile edge
+    # (lest the halo appear as a cliff to the Sobel filter, or as unknown terrain to shadowing)
+    elevation = numpy.pad(numpy.asarray(dsm.elevation.values, dtype=numpy.float32),
+                          ((top, bottom), (left, right)), mode='edge')
+
+    for (dx, dy), (tile_index, tile) in neighbours.items():
+        source_rows, target_rows = _parts(-dy, (top, bottom), rows)
+        source_cols, target_cols = _parts(dx, (left, right), cols)
+        elevation[target_rows, target_cols] = cache.get(tile_index, source_rows, source_cols,
+                                                        lambda r, c: load(tile, r, c))
+
+    x, y = dsm.x.values, dsm.y.values
+    dx_M, dy_M = x[1] - x[0], y[1] - y[0]
+    coords = [('y', y[0] + dy_M * numpy.arange(-top, rows + bottom)),
+              ('x', x[0] + dx_M * numpy.arange(-left, cols + right))]
+    extended = xarray.Dataset({'elevation': xarray.DataArray(elevation, coords=coords)}, attrs=dict(dsm.attrs))
+    extended.attrs['halo'] = widths
+    return extended
+
+def crop(array, widths):
+    """Undo the halo extension of a (2D) result"""
+    top, bottom, left, right = widths
+    return array[top:array.shape[0] - bottom, left:array.shape[1] - right]
@@ -0,0 +1,84 @@
+"""
+Background writer adding completed datasets to the index.
+
+Indexing each output synchronously blocks the result loop on a database round-trip.
+Instead, records are buffered on a bounded queue (so that, should the database fall
+behind, producers wait rather than accumulate unbounded memory) and a background thread
+adds them in batches, each within one transaction where the index API provides them.
+Closing the writer (e.g. leaving its context) flushes everything still buffered.
+"""
+
+import contextlib
+import threading
+import time
+try:
+    import queue
+except ImportError: # python 2
+    import Queue as queue
+
+_STOP = object() # sentinel
+
+@contextlib.contextmanager
+def _no_transaction():
+    yield
+
+def transaction(index):
+    """Transaction context of the index, if supported by this datacube version"""
+    begin = getattr(index, 'transaction', None)
+    return begin() if begin is not None else _no_transaction()
+
+class IndexWriter(object):
+    """Add datasets to the index in batches, from a background thread"""
+    def __init__(self, index, batch=20, maxsize=200, interval=5.0):
+        self.index = index
+        self.batch = batch
+        self.interval = interval # seconds, longest a record waits for its batch to fill
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.written = 0
+        self.thread = threading.Thread(target=self._run, name='IndexWriter')
+        self.thread.daemon = True
+        self.thread.start()
+    def add(self, dataset):
+        """Queue a dataset for indexing (blocking while the queue is full)"""
+        if self.error is not None:
+            raise self.error
+        self.queue.put(dataset)
+    def _batches(self):
+        """Yield batches from the queue, until stopped"""
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.interval
+            while len(batch) < self.batch and batch[-1] is not _STOP:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+            stop = batch[-1] is _STOP
+            if stop:
+                batch.pop()
+            if batch:
+                yield batch
+            if stop:
+                return
+    def _run(self):
+        for batch in self._batches():
+            if self.error is not None:
+                continue # drain (lest producers block), having already failed
+            try:
+                with transaction(self.index):
+                    for dataset in batch:
+                        self.index.datasets.add(dataset, skip_sources=True)
+                self.written += len(batch)
+            except Exception as e:
+                self.error = e
+    def close(self):
+        """Flush buffered datasets, and stop"""
+        self.queue.put(_STOP)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,110 @@
+"""
+Pipelined execution of a sequence of tasks, overlapping I/O with compute.
+
+Each task has three stages: load (read inputs), compute, and write (outputs). While task N
+computes (on the calling thread), the inputs of the following tasks are loaded on I/O threads
+and the output of the preceding task is written on another, so that neither the CPU nor the
+disk waits on the other. Queues are bounded (by the prefetch depth), and so is memory: inputs
+are only prefetched while the bytes held (from loading until written) are within a budget.
+"""
+
+import collections
+import itertools
+import threading
+import concurrent.futures
+
+class Budget(object):
+    """
+    Bytes held, blocking acquisition beyond a limit (except when nothing is held).
+
+    Acquisitions are granted in order of ticket (i.e. of task), lest a later task hold
+    the budget that an earlier one (which must be consumed first) is waiting for.
+    Once cancelled (e.g. as the pipeline fails), waiting and later acquisitions raise.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.turn = 0
+        self.cancelled = False
+        self.condition = threading.Condition()
+    def acquire(self, n, ticket):
+        with self.condition:
+            while ticket != self.turn or (self.used and self.used + n > self.limit):
+                if self.cancelled:
+                    raise RuntimeError('Budget cancelled')
+                self.condition.wait()
+            if self.cancelled:
+                raise RuntimeError('Budget cancelled')
+            self.used += n
+            self.turn += 1
+            self.condition.notify_all()
+    def adjust(self, n):
+        """Correct a previous acquisition (without blocking)"""
+        with self.condition:
+            self.used += n
+            self.condition.notify_all()
+    def release(self, n):
+        self.adjust(-n)
+    def cancel(self):
+        """Wake all waiters (which raise), e.g. as bytes held will never be released"""
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+def pipelined(tasks, load, compute, write, budget, size, depth=2):
+    """
+    List of write(task, inputs, compute(inputs)) for each task, where inputs = load(task).
+
+    :param budget: bytes (of inputs) that may be held at once
+    :param size: function estimating the bytes held by a task's inputs
+    :param depth: tasks loaded ahead (i.e. I/O threads for loading)
+    """
+    budget = Budget(budget)
+    estimate = [0] # bytes, of the last inputs loaded (as the estimate for the next)
+
+    def prefetch(task, ticket):
+        expected = estimate[0]
+        budget.acquire(expected, ticket)
+        try:
+            inputs = load(task)
+        except:
+            budget.release(expected)
+            raise
+        held = size(inputs)
+        budget.adjust(held - expected)
+        estimate[0] = held
+        return inputs, held
+
+    def store(task, inputs, held, output):
+        try:
+            return write(task, inputs, output)
+        finally:
+            budget.release(held) # inputs are no longer needed
+
+    loader = concurrent.futures.ThreadPoolExecutor(depth)
+    writer = concurrent.futures.ThreadPoolExecutor(1)
+    tasks = enumerate(tasks) # tickets
+    loads = collections.deque((task, loader.submit(prefetch, task, ticket))
+                              for ticket, task in itertools.islice(tasks, depth))
+    writes = []
+    try:
+        while loads:
+            task, loading = loads.popleft()
+            inputs, held = loading.result()
+            for ticket, following in itertools.islice(tasks, 1):
+                loads.append((following, loader.submit(prefetch, following, ticket)))
+            output = compute(inputs)
+            unwritten = [writing for writing in writes[-depth:] if not writing.done()]
+            if len(unwritten) >= depth: # bound the write queue (the writer is first-in-first-out)
+                unwritten[0].result()
+            writes.append(writer.submit(store, task, inputs, held, output))
+            del inputs, output
+        return [writing.result() for writing in writes]
+    except BaseException:
+        budget.cancel() # lest prefetches wait forever (on inputs that will not be written)
+        raise
+    finally:
+        for task, loading in loads:
+            loading.cancel()
+        loader.shutdown(wait=False)
+        writer.shutdown(wait=False)
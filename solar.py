@@ -0,0 +1,126 @@
+"""
+Batched solar geometry for a whole task list.
+
+Computing the sun position separately in every worker (constructing a GeoPolygon, reprojecting
+it, and creating an ephem.Observer per task) puts ephem and the CRS machinery on the hot path.
+Instead, all tile centres are reprojected in one call, and the sun position for every
+(tile centre, time) pair is evaluated by the NOAA solar position algorithm vectorised over
+the batch (agreeing with ephem to within about 0.05 degree, including atmospheric refraction).
+
+The result for each task is the same tuple as terrain_greg.solar_vector, and is attached to
+the task so that workers can pass it straight through (see terrain_greg.shadows_and_slope).
+"""
+
+import numpy
+from osgeo import osr
+
+def solar_position(lon, lat, time):
+    """
+    Apparent sun azimuth (clockwise from true north) and altitude, in radians.
+
+    Inputs are arrays of longitude and latitude (degrees) and UTC times (numpy datetime64).
+    """
+    lon, lat = numpy.asarray(lon, dtype=float), numpy.asarray(lat, dtype=float)
+    seconds = (numpy.asarray(time, dtype='datetime64[ns]') - numpy.datetime64('1970-01-01')) / numpy.timedelta64(1, 's')
+    julian_century = (seconds / 86400.0 + 2440587.5 - 2451545.0) / 36525.0
+    T = julian_century
+    sin, cos, rad, deg = numpy.sin, numpy.cos, numpy.radians, numpy.degrees
+
+    mean_long = (280.46646 + T*(36000.76983 + T*0.0003032)) % 360
+    mean_anom = rad(357.52911 + T*(35999.05029 - 0.0001537*T))
+    eccent = 0.016708634 - T*(0.000042037 + 0.0000001267*T)
+    centre = sin(mean_anom)*(1.914602 - T*(0.004817 + 0.000014*T)) \
+             + sin(2*mean_anom)*(0.019993 - 0.000101*T) + sin(3*mean_anom)*0.000289
+    omega = rad(125.04 - 1934.136*T)
+    app_long = rad(mean_long + centre - 0.00569 - 0.00478*sin(omega))
+    obliquity = rad(23 + (26 + (21.448 - T*(46.815 + T*(0.00059 - T*0.001813)))/60)/60 + 0.00256*cos(omega))
+    declination = numpy.arcsin(sin(obliquity)*sin(app_long))
+
+    # equation of time (minutes)
+    y = numpy.tan(obliquity/2)**2
+    L0 = rad(mean_long)
+    eq_time = 4*deg(y*sin(2*L0) - 2*eccent*sin(mean_anom) + 4*eccent*y*sin(mean_anom)*cos(2*L0)
+                    - 0.5*y*y*sin(4*L0) - 1.25*eccent*eccent*sin(2*mean_anom))
+
+    true_solar_time = ((seconds % 86400)/60.0 + eq_time + 4*lon) % 1440
+    hour_angle = rad(true_solar_time/4 - 180)
+
+    phi = rad(lat)
+    cos_zenith = numpy.clip(sin(phi)*sin(declination) + cos(phi)*cos(declination)*cos(hour_angle), -1, 1)
+    zenith = numpy.arccos(cos_zenith)
+    cos_az = numpy.clip((sin(phi)*cos_zenith - sin(declination)) / (cos(phi)*sin(zenith)), -1, 1)
+    azimuth = numpy.where(hour_angle > 0, numpy.arccos(cos_az) + numpy.pi, 3*numpy.pi - numpy.arccos(cos_az))
+    azimuth %= 2*numpy.pi
+
+    # atmospheric refraction (arc seconds)
+    elevation = 90 - deg(zenith)
+    t = numpy.tan(rad(elevation))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        refraction = numpy.select([elevation > 85, elevation > 5, elevation > -0.575],
+                                  [0.0,
+                                   58.1/t - 0.07/t**3 + 0.000086/t**5,
+                                   1735 + elevation*(-518.2 + elevation*(103.4 + elevation*(-12.79 + elevation*0.711)))],
+                                  -20.772/t)
+    altitude = rad(elevation + refraction/3600)
+
+    return azimuth, altitude
+
+def _to_lonlat(crs):
+    """Coordinate transformation from the (datacube) CRS to longitude and latitude"""
+    source = osr.SpatialReference()
+    source.SetFromUserInput(crs.crs_str)
+    target = osr.SpatialReference()
+    target.ImportFromEPSG(4326)
+    for sr in (source, target):
+        if hasattr(sr, 'SetAxisMappingStrategy'): # GDAL 3 otherwise swaps geographic axes
+            sr.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return osr.CoordinateTransformation(source, target)
+
+def solar_vectors(centres, times, crs):
+    """
+    Batch equivalent of terrain_greg.solar_vector, for sequences of points (in crs) and times.
+
+    Returns a list of (x, y, z, sun_az, sun_alt) tuples, with azimuth relative to grid north.
+    """
+    centres = numpy.asarray(centres, dtype=float).reshape(-1, 2)
+    transform = _to_lonlat(crs)
+    points = transform.TransformPoints([tuple(p) for p in centres] +
+                                       [(x, y + 100) for x, y in centres])
+    lonlat = numpy.array(points)[:, :2]
+    lon, lat = lonlat[:len(centres)].T
+    dlon, dlat = (lonlat[len(centres):] - lonlat[:len(centres)]).T
+    # azimuth north to east of the vertical direction of the crs
+    vert_az = numpy.arctan2(dlon*numpy.cos(numpy.radians(lat)), dlat)
+
+    azimuth, altitude = solar_position(lon, lat, times)
+    sun_az = azimuth - vert_az
+    x = numpy.sin(sun_az)*numpy.cos(altitude)
+    y = -numpy.cos(sun_az)*numpy.cos(altitude)
+    z = numpy.sin(altitude)
+    return [tuple(float(v) for v in vector) for vector in zip(x, y, z, sun_az, altitude)]
+
+def tile_centre(geobox):
+    """Coordinates of the central pixel of a tile (as picked by terrain_greg.shadows_and_slope)"""
+    affine = geobox.affine
+    return affine * (geobox.width//2 + 0.5, geobox.height//2 + 0.5)
+
+def attach_solar_vectors(tasks):
+    """
+    Extend each task ((nbar, pq, dsm), file_path, ...) with the solar vector for its tile and acquisition
+    (inserted after the file path, ahead of any further task arguments).
+
+    Tasks are grouped by CRS, so that each group is reprojected in a single call.
+    """
+    tasks = list(tasks)
+    groups = {}
+    for i, task in enumerate(tasks):
+        source, pq, dsm = task[0]
+        groups.setdefault(str(dsm.geobox.crs), []).append(i)
+    solar = [None] * len(tasks)
+    for indices in groups.values():
+        tiles = [tasks[i][0][2] for i in indices]
+        centres = [tile_centre(tile.geobox) for tile in tiles]
+        times = [tasks[i][0][0].sources.time.values[0] for i in indices]
+        for i, vector in zip(indices, solar_vectors(centres, times, tiles[0].geobox.crs)):
+            solar[i] = vector
+    return [task[:2] + (vector,) + task[2:] for task, vector in zip(tasks, solar)]
@@ -0,0 +1,113 @@
+"""
+Task store (SQLite), as a seekable alternative to the pickled task stream.
+
+Records each task with its status (pending, running, done or failed) and timing.
+Tasks are claimed in batches sharing a group (e.g. a DSM tile, see boilerplate.group_tasks)
+within an immediate transaction, so that any number of orchestrators (on different nodes)
+can drain one store concurrently without duplicating work. Optionally, each orchestrator
+may be restricted to a shard (i/N) of the groups. Tasks left running by an interrupted
+orchestrator, or that failed, can be returned to pending (resume).
+
+Note SQLite relies on file locking, which some network filesystems implement poorly.
+"""
+
+import os
+import pickle
+import socket
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    grp INTEGER NOT NULL,
+    task BLOB NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    claimed REAL,
+    finished REAL,
+    duration REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS pending ON tasks (status, grp, id);
+"""
+
+def parse_shard(text):
+    """Parse 'i/N' (zero-based shard i of N) as a tuple"""
+    i, n = (int(part) for part in text.split('/'))
+    if not 0 <= i < n:
+        raise ValueError('Shard index out of range: ' + text)
+    return i, n
+
+class TaskStore(object):
+    """Tasks (argument tuples) and their progress, in an SQLite file"""
+    def __init__(self, path, timeout=600):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None) # explicit transactions
+        self.connection.executescript(SCHEMA)
+        self.worker = '%s:%d' % (socket.gethostname(), os.getpid())
+    def _execute(self, *args):
+        return self.connection.execute(*args)
+    def add(self, tasks, group=None):
+        """Insert tasks (in one transaction), numbering consecutive runs of equal group(task)"""
+        count = 0
+        self._execute('BEGIN IMMEDIATE')
+        try:
+            number = self._execute('SELECT COALESCE(MAX(grp), -1) FROM tasks').fetchone()[0]
+            previous = object()
+            for task in tasks:
+                key = group(task) if group is not None else count
+                if key != previous:
+                    number += 1
+                    previous = key
+                blob = sqlite3.Binary(pickle.dumps(task, pickle.HIGHEST_PROTOCOL))
+                self._execute('INSERT INTO tasks (grp, task) VALUES (?, ?)', (number, blob))
+                count += 1
+            self._execute('COMMIT')
+        except:
+            self._execute('ROLLBACK')
+            raise
+        return count
+    def claim(self, size=0, shard=None):
+        """Claim pending tasks of one group (at most size, if nonzero): list of (id, task)"""
+        condition, parameters = "status = 'pending'", ()
+        if shard is not None:
+            condition += ' AND grp % ? = ?'
+            parameters = (shard[1], shard[0])
+        self._execute('BEGIN IMMEDIATE') # serialises claims across processes
+        try:
+            rows = self._execute('SELECT id, task FROM tasks WHERE ' + condition +
+                                 ' AND grp = (SELECT MIN(grp) FROM tasks WHERE ' + condition + ')' +
+                                 ' ORDER BY id LIMIT ?', parameters + parameters + (size or -1,)).fetchall()
+            if rows:
+                self._execute('UPDATE tasks SET status = ?, worker = ?, claimed = ? WHERE id IN (%s)'
+                              % ','.join('?' * len(rows)), ('running', self.worker, time.time()) + tuple(i for i, _ in rows))
+            self._execute('COMMIT')
+        except:
+            self._execute('ROLLBACK')
+            raise
+        return [(i, pickle.loads(bytes(blob))) for i, blob in rows]
+    def finish(self, ids, duration=None, error=None):
+        """Record claimed tasks as done (or failed, if error)"""
+        if not ids:
+            return
+        status = 'failed' if error is not None else 'done'
+        self._execute('UPDATE tasks SET status = ?, finished = ?, duration = ?, error = ? WHERE id IN (%s)'
+                      % ','.join('?' * len(ids)), (status, time.time(), duration, error) + tuple(ids))
+    def resume(self, stale=0):
+        """Return failed tasks, and tasks claimed more than stale seconds ago but unfinished, to pending"""
+        cursor = self._execute("UPDATE tasks SET status = 'pending', worker = NULL, claimed = NULL, error = NULL "
+                               "WHERE status = 'failed' OR (status = 'running' AND claimed < ?)",
+                               (time.time() - stale,))
+        return cursor.rowcount
+    def counts(self):
+        """Number of tasks by status"""
+        return dict(self._execute('SELECT status, COUNT(*) FROM tasks GROUP BY status').fetchall())
+    def batches(self, size=0, shard=None):
+        """Yield claimed batches (ids, tasks) until none remain pending"""
+        while True:
+            claimed = self.claim(size, shard)
+            if not claimed:
+                return
+            ids, tasks = zip(*claimed)
+            yield list(ids), list(tasks)
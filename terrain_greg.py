@@ -1,15 +1,60 @@
 import numpy
-import ephem
 from scipy import ndimage
 from pandas import to_datetime
-from datacube.model import CRS, GeoPolygon
 import math
+import multiprocessing.pool
 import xarray
 
 UNKNOWN = -1
 LIT = 255
 SHADED = 0
 
+SHADE_BAND_ROWS = 256 # rows of the rotated elevation model shaded per vectorised call
+THREADS = 1 # worker threads for the terrain stage (numpy and scipy kernels release the GIL)
+
+_pools = {}
+
+def _bands(rows, band_rows=SHADE_BAND_ROWS):
+    """Slices partitioning rows into bands"""
+    return [slice(start, min(start + band_rows, rows)) for start in range(0, rows, band_rows)]
+
+def _map(function, items, threads=None):
+    """List of function results for each item, computed on a pool of THREADS threads (if more than one)"""
+    threads = threads or THREADS
+    if threads <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    if threads not in _pools:
+        _pools[threads] = multiprocessing.pool.ThreadPool(threads)
+    return _pools[threads].map(function, items, chunksize=1)
+
+def _rotate(array, degrees, reshape, cval, threads=None):
+    """
+    Equivalent of ndimage.rotate (cubic, unfiltered, float32 output), for a thread pool.
+
+    Rotation is an affine map of output to input coordinates, so bands of output rows
+    are interpolated independently by offsetting the map (with the same centring as scipy).
+    """
+    if (threads or THREADS) <= 1:
+        return ndimage.interpolation.rotate(array, degrees, reshape=reshape, output=numpy.float32,
+                                            cval=cval, prefilter=False)
+    angle = math.radians(degrees)
+    c, s = math.cos(angle), math.sin(angle)
+    matrix = numpy.array([[c, s], [-s, c]])
+    in_shape = numpy.array(array.shape)
+    if reshape:
+        corners = matrix.dot([[0, 0, in_shape[0], in_shape[0]], [0, in_shape[1], 0, in_shape[1]]])
+        out_shape = (corners.max(axis=1) - corners.min(axis=1) + 0.5).astype(int)
+    else:
+        out_shape = in_shape
+    offset = (in_shape - 1) / 2.0 - matrix.dot((out_shape - 1) / 2.0)
+
+    output = numpy.empty(tuple(out_shape), dtype=numpy.float32)
+    def rotate_band(band):
+        ndimage.affine_transform(array, matrix, offset + matrix.dot([band.start, 0]), output=output[band],
+                                 order=3, cval=cval, prefilter=False)
+    _map(rotate_band, _bands(out_shape[0]), threads)
+    return output
+
 
 def _shadeRow(shade_mask, elev_M, sun_alt_deg, pixel_scale_M, no_data, fuzz=0.0):
     """
@@ -35,7 +80,57 @@ def _shadeRow(shade_mask, elev_M, sun_alt_deg, pixel_scale_M, no_data, fuzz=0.0)
 
     return shade_mask
 
+def _shadeRows(shade_mask, elev_M, sun_alt_deg, pixel_scale_M, no_data, fuzz=0.0):
+    """
+    shade every row of the supplied (2D) elevation model at once, equivalently to _shadeRow
+
+    Tips (light->shadow transitions) cast a shadow whose level falls by tanSunAlt*pixel_scale_M
+    per pixel, so offsetting each level by the ramp makes the shadow over each pixel a running
+    maximum (numpy.maximum.accumulate) of the offset levels of the preceding tips.
+    As in _shadeRow, a tip which is already in the shadow of an earlier tip does not cast
+    its own (fuzzed) shadow. That set of casting tips is found by fixed-point iteration
+    (starting from all tips), repeating only for rows that have yet to converge.
+    """
+
+    tanSunAlt = math.tan(sun_alt_deg)
+    rows, cols = elev_M.shape
+
+    # pure terrain angle shadow
+    lit = numpy.empty(elev_M.shape, dtype=bool)
+    lit[:, 0] = True
+    lit[:, 1:] = (elev_M[:, :-1]-elev_M[:, 1:])/pixel_scale_M < tanSunAlt
+
+    tips = numpy.zeros_like(lit)
+    tips[:, :-1] = lit[:, :-1] & ~lit[:, 1:]
+
+    # project shadows from tips, as a running maximum
+    ramp = numpy.arange(cols)*(tanSunAlt*pixel_scale_M)
+    level = (elev_M + fuzz) + ramp
+    horizon = numpy.empty_like(level)
+    casting = tips.copy()
+    pending = numpy.arange(rows)
+    while pending.size:
+        elev = elev_M[pending]
+        shadow = numpy.where(casting[pending], level[pending], -numpy.inf)
+        numpy.maximum.accumulate(shadow, axis=1, out=shadow)
+        horizon[pending] = shadow
+        prior = numpy.empty_like(shadow)
+        prior[:, 0] = -numpy.inf
+        prior[:, 1:] = shadow[:, :-1]
+        update = tips[pending] & ~(prior > elev + ramp) # (exactly unshaded at the tip itself)
+        changed = (update != casting[pending]).any(axis=1)
+        casting[pending] = update
+        pending = pending[changed]
+
+    shade_mask[:] = numpy.where(~lit | (horizon > elev_M + ramp), SHADED, LIT)
+    shade_mask[elev_M == no_data] = UNKNOWN
+
+    return shade_mask
+
 def solar_vector(p, time, crs):
+    import ephem # (only if not precomputed, see solar module)
+    from datacube.model import CRS, GeoPolygon
+
     poly = GeoPolygon([p, (p[0], p[1] + 100)], crs).to_crs(CRS('EPSG:4326'))
     lon, lat = poly.points[0]
     dlon = poly.points[1][0] - lon
@@ -57,7 +152,150 @@ def solar_vector(p, time, crs):
     return x, y, z, sun_az, sun.alt
 
 
-def shadows_and_slope(tile, time):
+def _rotated_shadows(elevation, sun_az, sun_alt, pixel_scale_M, no_data, fuzz=10.0):
+    """
+    Shadow mask by rotating the elevation model to align rows with the sun, shading rows,
+    and rotating back (undoing the border enlargement associated with the rotation).
+    """
+    y_size, x_size = elevation.shape
+    if y_size != x_size: # the rotations assume a square raster (e.g. not a tile extended by a halo)
+        size = max(y_size, x_size)
+        top, left = (size - y_size) // 2, (size - x_size) // 2
+        square = numpy.full((size, size), no_data, dtype=elevation.dtype)
+        square[top:top + y_size, left:left + x_size] = elevation
+        shadows = _rotated_shadows(square, sun_az, sun_alt, pixel_scale_M, no_data, fuzz=fuzz)
+        return shadows[top:top + y_size, left:left + x_size]
+    rot_degrees = 90.0 + math.degrees(sun_az)
+
+    rotated_elv_array = _rotate(elevation, rot_degrees, reshape=True, cval=no_data)
+
+    # create the shadow mask by ray-tracying along each row (in bands of rows, to bound memory)
+    shadows = numpy.zeros_like(rotated_elv_array)
+    def shade(band):
+        _shadeRows(shadows[band], rotated_elv_array[band], sun_alt, pixel_scale_M, no_data, fuzz=fuzz)
+    _map(shade, _bands(rotated_elv_array.shape[0]))
+
+    rotated_elv_array = None # (free before rotating back; python 2 cannot del a variable of a closure)
+
+    shadows = _rotate(shadows, -rot_degrees, reshape=False, cval=no_data)
+
+    dr = (shadows.shape[0] - y_size) // 2
+    dc = (shadows.shape[1] - x_size) // 2
+
+    return shadows[dr:dr + y_size, dc:dc + x_size]
+
+def _swept_shadows(elevation, sun_az, sun_alt, pixel_scale_M, no_data, fuzz=10.0):
+    """
+    Shadow mask by sweeping digital (Bresenham) lines along the sun direction, in the native grid.
+
+    Orients the array (by transposing and/or flipping, which is exact) so that light travels
+    towards increasing columns, and no more than one row per column. Shearing each column by
+    a whole number of rows then makes every line of sunlight a row, so that the rows can be
+    shaded directly (at the mean pixel spacing along the line) and the mask scattered back.
+    Every native pixel is visited exactly once, with no resampling or border enlargement.
+    """
+    elevation = numpy.asarray(elevation, dtype=numpy.float32)
+
+    # direction of travel of the light, in (column, row) pixel units (rows increase southward)
+    dcol, drow = -math.sin(sun_az), math.cos(sun_az)
+
+    transpose = abs(drow) > abs(dcol)
+    if transpose:
+        elevation = elevation.T
+        dcol, drow = drow, dcol
+    flip = dcol < 0
+    if flip:
+        elevation = elevation[:, ::-1]
+        dcol = -dcol
+
+    slant = drow / dcol # rows per column
+    step_M = pixel_scale_M * math.hypot(1.0, slant)
+
+    rows, cols = elevation.shape
+    columns = numpy.arange(cols)
+    shear = numpy.round(columns * slant).astype(int)
+
+    shadows = numpy.empty(elevation.shape, dtype=numpy.float32)
+    first, last = -shear.max(), rows - shear.min()
+    def sweep(lines): # (each line covers distinct pixels, so bands may be swept concurrently)
+        r = first + numpy.arange(lines.start, lines.stop)[:, None] + shear # native row of each pixel of each line
+        inside = (r >= 0) & (r < rows)
+        c = numpy.broadcast_to(columns, r.shape)
+        band = numpy.where(inside, elevation[r.clip(0, rows-1), c], numpy.float32(no_data))
+        shaded = numpy.zeros_like(band)
+        _shadeRows(shaded, band, sun_alt, step_M, no_data, fuzz=fuzz)
+        shadows[r[inside], c[inside]] = shaded[inside]
+    _map(sweep, _bands(last - first))
+
+    if flip:
+        shadows = shadows[:, ::-1]
+    if transpose:
+        shadows = shadows.T
+    return shadows
+
+SHADOW_METHODS = {'rotate': _rotated_shadows, 'sweep': _swept_shadows}
+
+def shadow_agreement(a, b):
+    """
+    Fraction of pixels given the same class (LIT, SHADED or UNKNOWN) by two shadow masks.
+
+    Resampled masks are classified by nearest class value.
+    """
+    classes = numpy.array([UNKNOWN, SHADED, LIT])
+    def classify(mask):
+        mask = numpy.asarray(mask)
+        return numpy.abs(mask[..., None] - classes).argmin(axis=-1)
+    return (classify(a) == classify(b)).mean()
+
+def terrain_derivatives(tile):
+    """
+    Time-invariant terrain products of the DSM: Sobel gradients, normal vector length and slope (degrees).
+
+    These depend only on the DSM, so may be reused for every acquisition of the tile (see terrain_cache).
+    Computed in bands of rows (each overlapping its neighbours by the Sobel radius) on the thread pool.
+    """
+    elevation = tile.elevation.values
+    rows = elevation.shape[0]
+    x_scale, y_scale = abs(8*tile.affine.a), abs(8*tile.affine.e)
+
+    def derive(band):
+        start, stop = max(band.start - 1, 0), min(band.stop + 1, rows)
+        crop = slice(band.start - start, band.stop - start)
+
+        xgrad = ndimage.sobel(elevation[start:stop], axis=1)[crop] / x_scale
+        ygrad = ndimage.sobel(elevation[start:stop], axis=0)[crop] / y_scale
+
+        # length of the terrain normal vector
+        norm_len = numpy.sqrt(xgrad*xgrad + ygrad*ygrad + 1.0)
+
+        #hypot = numpy.hypot(xgrad, ygrad)
+        #slope = numpy.degrees(numpy.arctan(hypot))
+
+        slope = numpy.degrees(numpy.arccos(1.0/norm_len))
+
+        return xgrad, ygrad, norm_len, slope
+
+    return tuple(numpy.concatenate(parts) for parts in zip(*_map(derive, _bands(rows))))
+
+def terrain_gradients(tile):
+    """
+    Sobel gradients (xgrad, ygrad) of the DSM as float32, i.e. terrain_derivatives without the
+    normal length and slope (which terrain_masks avoids), for caching (see terrain_cache).
+    """
+    elevation = tile.elevation.values
+    rows = elevation.shape[0]
+    x_scale, y_scale = abs(8*tile.affine.a), abs(8*tile.affine.e)
+
+    def derive(band):
+        start, stop = max(band.start - 1, 0), min(band.stop + 1, rows)
+        crop = slice(band.start - start, band.stop - start)
+        block = numpy.asarray(elevation[start:stop], dtype=numpy.float32)
+        return ndimage.sobel(block, axis=1)[crop] / x_scale, ndimage.sobel(block, axis=0)[crop] / y_scale
+
+    return tuple(numpy.concatenate(parts) for parts in zip(*_map(derive, _bands(rows))))
+
+def shadows_and_slope(tile, time, shadow_method='rotate', derivatives=None, shadow_cache=None,
+                      solar_vec=None):
     """
     Terrain shadow masking (Greg's implementation) and slope masking.
 
@@ -69,59 +307,100 @@ def shadows_and_slope(tile, time):
     and assuming the input projection is Mercator-like i.e. preserves bearings).
     For each row, finds each threshold pixel (where the slope just turns away from the sun) and raytraces
     (i.e. using a ramp, masks the other pixels shaded by the pillar of that pixel).
+    All rows of a band are traced together, as a running maximum of ramp-offset elevations.
     Reprojects shadow mask (and undoes border enlargement associated with the rotation).     
 
-    TODO (BL) -- profile, and explore numpy.minimum.accumulate (make-monotonic) style alternative
-                 and maybe fewer resamplings (or come up with something better still).
+    Alternatively (shadow_method='sweep'), traces the same rows along digital lines of sunlight
+    in the native grid, avoiding both rotations (see SHADOW_METHODS and shadow_agreement).
+
+    Precomputed (e.g. cached) derivatives of the DSM may be supplied, otherwise see terrain_derivatives.
+    Shadow masks may be memoised by quantised sun position (see terrain_cache.ShadowCache).
+    The solar vector may be precomputed for a batch of tasks (see solar module).
+
+    TODO (BL) -- profile, and explore fewer resamplings (or come up with something better still).
     """
     
-    y_size, x_size = tile.elevation.shape
-
-    xgrad = ndimage.sobel(tile.elevation, axis=1) / abs(8*tile.affine.a)
-    ygrad = ndimage.sobel(tile.elevation, axis=0) / abs(8*tile.affine.e)
+    if derivatives is None:
+        derivatives = terrain_derivatives(tile)
+    xgrad, ygrad, norm_len, slope = derivatives
 
-    # length of the terrain normal vector
-    norm_len = numpy.sqrt(xgrad*xgrad + ygrad*ygrad + 1.0)
+    if solar_vec is None:
+        solar_vec = tile_solar_vector(tile, time)
+    sia = (solar_vec[2] - xgrad*solar_vec[0] - ygrad*solar_vec[1])/norm_len
+    sia = 90-numpy.degrees(numpy.arccos(sia))
 
-    #hypot = numpy.hypot(xgrad, ygrad)
-    #slope = numpy.degrees(numpy.arctan(hypot))
+    shadows = terrain_shadows(tile, solar_vec, shadow_method, shadow_cache)
 
-    slope = numpy.degrees(numpy.arccos(1.0/norm_len))
+    return shadows, slope, sia
 
+def tile_solar_vector(tile, time):
+    """Solar vector (see solar_vector) at the middle of a DSM tile"""
+    y_size, x_size = tile.elevation.shape
     x,y = tile.dims.keys()
     tile_center = (tile[x].values[x_size/2], tile[y].values[y_size/2])
-    solar_vec = solar_vector(tile_center, to_datetime(time), tile.crs)
-    sia = (solar_vec[2] - xgrad*solar_vec[0] - ygrad*solar_vec[1])/norm_len
-    sia = 90-numpy.degrees(numpy.arccos(sia))
+    return solar_vector(tile_center, to_datetime(time), tile.crs)
+
+def terrain_shadows(tile, solar_vec, shadow_method='rotate', shadow_cache=None):
+    """Terrain shadow mask (DataArray of LIT, SHADED or UNKNOWN) of a DSM tile (see shadows_and_slope)"""
 
     # # TODO: water_band=SolarTerrainShadowSlope(self.dsm_path).filter(water_band)
-    rot_degrees = 90.0 + math.degrees(solar_vec[3])
-    sun_alt_deg = math.degrees(solar_vec[4])
-    # print solar_vec, rot_degrees, sun_alt_deg
     pixel_scale_M = 25.0 #TODO: proper res
     no_data = -1000
 
-    rotated_elv_array = ndimage.interpolation.rotate(tile.elevation.values,
-                                                     rot_degrees,
-                                                     reshape=True,
-                                                     output=numpy.float32,
-                                                     cval=no_data,
-                                                     prefilter=False)
+    def cast_shadows(sun_az, sun_alt):
+        return SHADOW_METHODS[shadow_method](tile.elevation.values, sun_az, sun_alt,
+                                             pixel_scale_M, no_data, fuzz=10.0)
+    if shadow_cache is None:
+        shadows = cast_shadows(solar_vec[3], solar_vec[4])
+    else:
+        shadows = shadow_cache.get(tile, solar_vec[3], solar_vec[4], cast_shadows,
+                                   variant=shadow_method, pixel_scale_M=pixel_scale_M)
+    return xarray.DataArray(shadows.reshape(tile.elevation.shape), coords=tile.elevation.coords)
 
-    # create the shadow mask by ray-tracying along each row
-    shadows = numpy.zeros_like(rotated_elv_array)
-    for row in range(0, rotated_elv_array.shape[0]):
-        _shadeRow(shadows[row], rotated_elv_array[row], solar_vec[4], pixel_scale_M, no_data, fuzz=10.0)
+def terrain_masks(tile, solar_vec, slope_threshold_deg, incidence_threshold_deg, gradients=None):
+    """
+    Steep slope and low solar incidence masks of a DSM tile, fused in float32 bands of rows.
+
+    Thresholds the same slope and incidence angles as shadows_and_slope, without the trigonometry:
+    the slope exceeds S where the squared gradient exceeds tan(S)**2, and the incidence angle is
+    below T where the dot product of the sun vector with the (unnormalised) terrain normal is below
+    sin(T) times the normal length. Only the two boolean masks are full-tile.
 
-    del rotated_elv_array
+    Optionally uses precomputed gradients (e.g. from terrain_cache), otherwise Sobel filters each band.
+    """
+    return elevation_masks(tile.elevation.values, abs(8*tile.affine.a), abs(8*tile.affine.e), solar_vec,
+                           slope_threshold_deg, incidence_threshold_deg, gradients=gradients)
 
-    shadows = ndimage.interpolation.rotate(shadows, -rot_degrees, reshape=False, output=numpy.float32, cval=no_data,
-                                          prefilter=False)
+def elevation_masks(elevation, x_scale, y_scale, solar_vec, slope_threshold_deg, incidence_threshold_deg,
+                    gradients=None):
+    """Steep slope and low solar incidence masks of a 2D elevation array (see terrain_masks)"""
+    rows = elevation.shape[0]
 
-    dr = (shadows.shape[0] - y_size) / 2
-    dc = (shadows.shape[1] - x_size) / 2
+    tan2_slope = numpy.float32(math.tan(math.radians(slope_threshold_deg))**2)
+    sin_incidence = numpy.float32(math.sin(math.radians(incidence_threshold_deg)))
+    sun_x, sun_y, sun_z = [numpy.float32(component) for component in solar_vec[:3]]
 
-    shadows = shadows[dr:dr + y_size, dc:dc + x_size]
-    shadows = xarray.DataArray(shadows.reshape(tile.elevation.shape), coords=tile.elevation.coords)
+    steep = numpy.empty(elevation.shape, dtype=numpy.bool_)
+    dim = numpy.empty(elevation.shape, dtype=numpy.bool_)
 
-    return shadows, slope, sia
+    def fused(band):
+        if gradients is None:
+            start, stop = max(band.start - 1, 0), min(band.stop + 1, rows)
+            crop = slice(band.start - start, band.stop - start)
+            block = numpy.asarray(elevation[start:stop], dtype=numpy.float32)
+            xgrad = ndimage.sobel(block, axis=1)[crop] / x_scale
+            ygrad = ndimage.sobel(block, axis=0)[crop] / y_scale
+        else:
+            xgrad = numpy.asarray(gradients[0][band], dtype=numpy.float32)
+            ygrad = numpy.asarray(gradients[1][band], dtype=numpy.float32)
+
+        squared = xgrad*xgrad + ygrad*ygrad
+        steep[band] = squared > tan2_slope
+
+        incidence = sun_z - xgrad*sun_x - ygrad*sun_y
+        squared += 1
+        numpy.sqrt(squared, out=squared) # length of the terrain normal vector
+        dim[band] = incidence < sin_incidence * squared
+
+    _map(fused, _bands(rows))
+    return steep, dim
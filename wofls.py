@@ -12,16 +12,20 @@ Issues:
     - previous documentation may be ambiguous or previous implementations may differ
       (e.g. saturation, bitfield)
     - Tile edge artifacts concerning cloud buffers and cloud or terrain shadows.
+      (Terrain shadows are addressed by the optional halo mode, see halo module.)
     - DSM may have different natural resolution to EO source.
       Should think about what CRS to compute in, and what resampling methods to use.
       Also, should quantify whether earth's curvature is significant on tile scale.
     - Yet to profile memory, CPU or IO usage.
+      (Tiles may be processed lazily in chunks, bounding memory, see chunked module.)
 """
 
 
 import numpy as np
-import classifier_josh as classifier
+import xarray
 import filters
+import blockwise
+import chunked
 from boilerplate import wofloven as boilerplate
 
 
@@ -31,12 +35,20 @@ from boilerplate import wofloven as boilerplate
 def woffles(source, pq, dsm):
     """Generate a Water Observation Feature Layer from NBAR, PQ and surface elevation inputs."""
 
-    water = classifier.classify(source.to_array(dim='band').data) \
-            | filters.eo_filter(source) \
-            | filters.pq_filter(pq.pixelquality.data) \
-            | filters.terrain_filter(dsm, source)
+    nbar = [source[name] for name in source.data_vars]
+
+    if chunked.is_lazy(pq.pixelquality.data): # inputs loaded as dask arrays
+        water = chunked.woffles_blockwise([band.data for band in nbar],
+                                          [band.nodata for band in nbar],
+                                          pq.pixelquality.data) \
+                | chunked.terrain_filter(dsm, source)
+    else:
+        water = blockwise.woffles_blockwise([band.data for band in nbar],
+                                            [band.nodata for band in nbar],
+                                            pq.pixelquality.data) \
+                | filters.terrain_filter(dsm, source)
 
     assert water.dtype == np.uint8
 
-    return water
+    return xarray.DataArray(water, coords=source.blue.coords) # (lazy, if chunked)
 
@@ -0,0 +1,217 @@
+"""
+Zarr output backend, as an alternative to NetCDF (see wofloven.write_task).
+
+Each output is a Zarr store (a directory of compressed chunks) readable by xarray.open_zarr.
+Chunks are aligned with acquisitions and tiles (one time step, and an integer fraction of
+the tile rows and columns), so that a time-series read of a region touches only its chunks.
+The bitfields are mostly constant (and sparse), so each chunk is bit-shuffled and then LZ4
+compressed (fast, both ways). Chunks are compressed and written concurrently (Blosc releases
+the GIL). Variables, coordinates and attributes (including the dataset document) are those
+of the NetCDF output (with the metadata consolidated, for fast opening).
+
+Alternatively, a TimeStack holds every acquisition of a tile (e.g. for a year) in one store,
+appended along time as scenes arrive, to cut file counts and per-file overheads. Each time
+slice is then indexed as a part of the stack (see wofloven.write_task).
+"""
+
+import contextlib
+import errno
+import fcntl
+import itertools
+import multiprocessing
+import os
+import numpy
+import concurrent.futures
+
+CHUNKS = {'time': 1, 'y': 1000, 'x': 1000} # 4000x4000 tiles (100km at 25m)
+TIME_UNITS = 'seconds since 1970-01-01 00:00:00'
+
+def compressor():
+    import numcodecs
+    return numcodecs.Blosc(cname='lz4', clevel=5, shuffle=numcodecs.Blosc.BITSHUFFLE)
+
+def _blocks(shape, chunks):
+    """Slices of each chunk of an array"""
+    ranges = [range(0, size, chunk) for size, chunk in zip(shape, chunks)]
+    for starts in itertools.product(*ranges):
+        yield tuple(slice(start, start + chunk) for start, chunk in zip(starts, chunks))
+
+def _seconds(values):
+    """Datetimes as CF time values"""
+    return ((values - numpy.datetime64('1970-01-01T00:00:00')) / numpy.timedelta64(1, 's')).astype(numpy.float64)
+
+def _encode(variable):
+    """Values and extra attributes of a variable, encoded for Zarr (CF conventions for time)"""
+    values = variable.values
+    if values.dtype.kind == 'M':
+        return _seconds(values), {'units': TIME_UNITS, 'calendar': 'standard'}
+    if values.dtype.kind in 'OSU': # e.g. dataset documents
+        decode = lambda value: value.decode('utf-8') if isinstance(value, bytes) else value
+        return numpy.array([decode(value) for value in values.ravel()], dtype=object).reshape(values.shape), {}
+    return values, {}
+
+def write_dataset_to_zarr(dataset, path, global_attributes=None, chunks=CHUNKS, threads=None):
+    """Write an xarray Dataset (e.g. a WOFL, see wofloven.write_task) as a new Zarr store"""
+    import zarr
+    import numcodecs
+
+    group = zarr.open_group(str(path), mode='w-') # lest existing output be overwritten
+    attributes = dict(global_attributes or {})
+    if 'crs' in dataset.attrs:
+        crs = dataset.attrs['crs']
+        attributes['crs'] = getattr(crs, 'wkt', str(crs))
+    group.attrs.update(attributes)
+
+    pool = concurrent.futures.ThreadPoolExecutor(threads or multiprocessing.cpu_count())
+    writes = []
+    try:
+        for name, variable in dataset.variables.items():
+            values, extra = _encode(variable)
+            attrs = dict(variable.attrs, **extra)
+            attrs['_ARRAY_DIMENSIONS'] = list(variable.dims) # xarray convention
+            shape = values.shape
+            if values.dtype == object:
+                array = group.create_dataset(name, shape=shape, dtype=object, object_codec=numcodecs.VLenUTF8())
+                array[...] = values
+            elif name in dataset.coords:
+                array = group.create_dataset(name, data=values, chunks=shape, compressor=None)
+            else:
+                chunking = tuple(min(chunks.get(dim, size), size) for dim, size in zip(variable.dims, shape))
+                array = group.create_dataset(name, shape=shape, chunks=chunking, dtype=values.dtype,
+                                             compressor=compressor(), fill_value=attrs.get('nodata'))
+                for block in _blocks(shape, chunking): # whole chunks, so writes are independent
+                    writes.append(pool.submit(array.__setitem__, block, values[block]))
+            array.attrs.update(attrs)
+        for write in writes:
+            write.result()
+    finally:
+        pool.shutdown()
+    zarr.consolidate_metadata(str(path)) # single metadata read, for opening
+
+
+class TimeStack(object):
+    """
+    Zarr store of the acquisitions of one tile, appended along time.
+
+    A slice is first reserved (extending the time dimension, under a file lock, as several
+    workers may append to the same stack), then written. Every variable along time is chunked
+    by single time steps, so that slices are written independently (without the lock).
+    The metadata document (DOCUMENT) is written last, so marks the slice complete: a slice
+    left incomplete (e.g. by a failed task) is reused when the acquisition is retried.
+
+    Slices are stored in order of arrival rather than of time (see load).
+    """
+    DOCUMENT = 'dataset' # variable of the metadata document of each slice
+    def __init__(self, path):
+        self.path = str(path)
+    @contextlib.contextmanager
+    def _lock(self):
+        try: # (the lock sits beside the stack, so its directory must exist before the stack does)
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    def _create(self, dataset, global_attributes, chunks):
+        """Empty store (no time steps) with the layout of the dataset"""
+        import zarr
+        import numcodecs
+
+        group = zarr.open_group(self.path, mode='w-')
+        attributes = dict(global_attributes or {})
+        if 'crs' in dataset.attrs:
+            crs = dataset.attrs['crs']
+            attributes['crs'] = getattr(crs, 'wkt', str(crs))
+        group.attrs.update(attributes)
+        for name, variable in dataset.variables.items():
+            values, extra = _encode(variable)
+            attrs = dict(variable.attrs, **extra)
+            attrs['_ARRAY_DIMENSIONS'] = list(variable.dims)
+            if 'time' not in variable.dims:
+                array = group.create_dataset(name, data=values, chunks=values.shape, compressor=None)
+            else:
+                shape = (0,) + values.shape[1:]
+                chunking = (1,) + tuple(min(chunks.get(dim, size), size)
+                                        for dim, size in zip(variable.dims[1:], values.shape[1:]))
+                if values.dtype == object:
+                    array = group.create_dataset(name, shape=shape, chunks=chunking, dtype=object,
+                                                 object_codec=numcodecs.VLenUTF8())
+                else:
+                    fill = attrs.get('nodata')
+                    array = group.create_dataset(name, shape=shape, chunks=chunking, dtype=values.dtype,
+                                                 compressor=compressor() if name not in dataset.coords else None,
+                                                 fill_value=fill)
+            array.attrs.update(attrs)
+    def __contains__(self, time):
+        """Whether an acquisition time is already in the stack"""
+        import zarr
+
+        if not os.path.exists(os.path.join(self.path, '.zgroup')):
+            return False
+        encoded = _seconds(numpy.atleast_1d(time).astype('datetime64[ns]'))
+        group = zarr.open_group(self.path, mode='r')
+        return any(self._complete(group, index) for index in self._slices(group, encoded))
+    def _slices(self, group, encoded):
+        """Indices of the slices (complete or not) of the encoded acquisition times"""
+        return numpy.nonzero(numpy.isin(group['time'][:], encoded))[0]
+    def _complete(self, group, index):
+        return bool(group[self.DOCUMENT][index]) # (unwritten reads as empty)
+    def reserve(self, dataset, global_attributes=None, chunks=CHUNKS):
+        """
+        Time index for the (single acquisition) dataset, creating the store if need be.
+
+        Raises if the acquisition is already (completely) in the stack, and reuses
+        an incomplete slice of the acquisition (i.e. retries).
+        """
+        import zarr
+
+        with self._lock():
+            if not os.path.exists(os.path.join(self.path, '.zgroup')):
+                self._create(dataset, global_attributes, chunks)
+            group = zarr.open_group(self.path, mode='r+')
+            time, _ = _encode(dataset.time)
+            for index in self._slices(group, time):
+                if self._complete(group, index):
+                    raise OSError(errno.EEXIST, 'Acquisition already in stack', self.path)
+                return int(index)
+            index = group['time'].shape[0]
+            for name, array in group.arrays():
+                if array.attrs['_ARRAY_DIMENSIONS'][:1] == ['time']:
+                    array.resize((index + 1,) + array.shape[1:])
+            group['time'][index] = time[0]
+            zarr.consolidate_metadata(self.path)
+        return index
+    def write(self, index, dataset, threads=None):
+        """Write the (single acquisition) dataset as the reserved time slice (the document last)"""
+        import zarr
+
+        group = zarr.open_group(self.path, mode='r+')
+        pool = concurrent.futures.ThreadPoolExecutor(threads or multiprocessing.cpu_count())
+        writes = []
+        try:
+            for name, variable in dataset.variables.items():
+                if variable.dims[:1] != ('time',) or name in ('time', self.DOCUMENT):
+                    continue
+                values, _ = _encode(variable)
+                array = group[name]
+                for block in _blocks(values.shape[1:], array.chunks[1:]):
+                    writes.append(pool.submit(array.__setitem__, (index,) + block, values[(0,) + block]))
+            for write in writes:
+                write.result()
+        finally:
+            pool.shutdown()
+        document, _ = _encode(dataset[self.DOCUMENT])
+        group[self.DOCUMENT][index] = document[0] # marks the slice complete
+    def load(self):
+        """Lazy xarray Dataset of the complete slices, in time order"""
+        import xarray
+
+        stack = xarray.open_zarr(self.path, consolidated=True)
+        complete = numpy.array([bool(document) for document in stack[self.DOCUMENT].values])
+        order = numpy.argsort(stack.time.values[complete], kind='mergesort')
+        return stack.isel(time=numpy.nonzero(complete)[0][order])